@@ -0,0 +1,262 @@
+"""asyncio based access to the Hetzner Cloud API.
+
+`AsyncHcloudClient` talks to the API over a pooled aiohttp session. nixops calls plugins
+synchronously from its own worker threads, so `ApiFacade` runs one event loop per API token in a
+background thread and exposes blocking methods returning the same bound models as the `hcloud`
+client. Lookups and action waits from every thread then share one loop and connection pool, and
+batches of them run concurrently.
+"""
+import asyncio
+import atexit
+import json
+import threading
+from typing import (Any, Callable, Coroutine, Dict, List, Mapping, Optional,
+                    Sequence, Tuple, TypeVar)
+
+import aiohttp
+import hcloud
+from hcloud.actions.client import BoundAction
+from hcloud.actions.domain import Action
+from hcloud.datacenters.client import BoundDatacenter
+from hcloud.images.client import BoundImage
+from hcloud.load_balancers.client import BoundLoadBalancer
+from hcloud.networks.client import BoundNetwork
+from hcloud.server_types.client import BoundServerType
+from hcloud.servers.client import BoundServer
+from hcloud.ssh_keys.client import BoundSSHKey
+from hcloud.volumes.client import BoundVolume
+
+API_ENDPOINT = "https://api.hetzner.cloud/v1"
+PER_PAGE = 50
+# Longest wait for actions, creating an image of a large disk can take several minutes
+ACTION_TIMEOUT = 30 * 60
+
+# Resource kind, as in the API path and `hcloud.Client` attribute -> bound model class
+BOUND_MODELS: Mapping[str, Callable[[Any, Dict[str, Any]], Any]] = {
+    "actions": BoundAction,
+    "datacenters": BoundDatacenter,
+    "images": BoundImage,
+    "load_balancers": BoundLoadBalancer,
+    "networks": BoundNetwork,
+    "server_types": BoundServerType,
+    "servers": BoundServer,
+    "ssh_keys": BoundSSHKey,
+    "volumes": BoundVolume,
+}
+
+T = TypeVar("T")
+Params = Sequence[Tuple[str, Any]]
+
+
+def _singular(kind: str) -> str:
+    return kind[:-1]
+
+
+class AsyncHcloudClient:
+    """Minimal asyncio Hetzner Cloud client returning the API's JSON objects.
+
+    Must be created and used on the same running event loop.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        endpoint: str = API_ENDPOINT,
+        connections: int = 16,
+        poll_interval: float = 1.0,
+        retries: int = 5,
+        action_timeout: float = ACTION_TIMEOUT,
+    ) -> None:
+        self.endpoint = endpoint
+        self.poll_interval = poll_interval
+        self.retries = retries
+        self.action_timeout = action_timeout
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=connections),
+            headers={
+                "Authorization": f"Bearer {token}",
+                "User-Agent": "nixops-hcloud",
+            },
+        )
+
+    async def close(self) -> None:
+        await self._session.close()
+
+    async def request(
+        self, method: str, path: str, params: Optional[Params] = None, **kwargs
+    ) -> Dict[str, Any]:
+        """Send a request, retrying with exponential backoff when rate limited.
+
+        Raises
+        ------
+        `hcloud.APIException`
+            If the API returns an error, or a response that isn't JSON.
+        """
+        for attempt in range(self.retries):
+            async with self._session.request(
+                method, self.endpoint + path, params=params, **kwargs
+            ) as resp:
+                status = resp.status
+                text = await resp.text()
+            try:
+                body = json.loads(text) if text else {}
+            except ValueError:
+                # e.g. an HTML error page from a proxy in front of the API
+                raise hcloud.APIException(
+                    code=None, message=f"HTTP {status}: {text[:200]}", details=None
+                ) from None
+            if status < 400:
+                return body
+            error = body.get("error", {})
+            if error.get("code") == "rate_limit_exceeded" and attempt < self.retries - 1:
+                await asyncio.sleep(self.poll_interval * 2 ** attempt)
+                continue
+            raise hcloud.APIException(
+                code=error.get("code"),
+                message=error.get("message"),
+                details=error.get("details"),
+            )
+        raise AssertionError("unreachable")
+
+    async def get_by_id(self, kind: str, id_: int) -> Dict[str, Any]:
+        body = await self.request("GET", f"/{kind}/{id_}")
+        return body[_singular(kind)]
+
+    async def get_all(self, kind: str, params: Params = ()) -> List[Dict[str, Any]]:
+        """All entities matching `params`, following pagination."""
+        results: List[Dict[str, Any]] = []
+        page: Optional[int] = 1
+        while page is not None:
+            body = await self.request(
+                "GET",
+                f"/{kind}",
+                params=list(params) + [("page", page), ("per_page", PER_PAGE)],
+            )
+            results.extend(body[kind])
+            page = body.get("meta", {}).get("pagination", {}).get("next_page")
+        return results
+
+    async def get_by_name(self, kind: str, name: str) -> Optional[Dict[str, Any]]:
+        body = await self.request("GET", f"/{kind}", params=[("name", name)])
+        return body[kind][0] if body[kind] else None
+
+    async def wait_for_actions(
+        self, ids: Sequence[int], callback: Optional[Callable[[], None]] = None
+    ) -> List[Dict[str, Any]]:
+        """Wait for all actions to finish, polling them with a single request per interval.
+
+        Raises
+        ------
+        `Exception`
+            If any of the actions fails, doesn't exist or is still running after
+            `action_timeout` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.action_timeout
+        pending = set(ids)
+        finished: Dict[int, Dict[str, Any]] = {}
+        while pending:
+            actions = await self.get_all("actions", [("id", i) for i in sorted(pending)])
+            missing = pending - {action["id"] for action in actions}
+            if missing:
+                raise Exception(
+                    f"Hetzner Cloud actions not found: {', '.join(map(str, sorted(missing)))}"
+                )
+            for action in actions:
+                if action["status"] == Action.STATUS_ERROR:
+                    raise Exception(
+                        f"Hetzner Cloud action {action['command']} failed: {action['error']}"
+                    )
+                if action["status"] != Action.STATUS_RUNNING:
+                    pending.discard(action["id"])
+                    finished[action["id"]] = action
+            if pending:
+                if loop.time() >= deadline:
+                    raise Exception(
+                        "Timed out waiting for Hetzner Cloud actions "
+                        + ", ".join(map(str, sorted(pending)))
+                    )
+                if callback is not None:
+                    callback()
+                await asyncio.sleep(self.poll_interval)
+        return [finished[i] for i in ids]
+
+
+class ApiFacade:
+    """Blocking interface to an `AsyncHcloudClient` running on a background event loop.
+
+    Use `ApiFacade.for_token` to share one instance, and so one loop and connection pool, between
+    all resources using the same token.
+    """
+
+    _instances: Dict[str, "ApiFacade"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, token: str) -> None:
+        # Only used to bind results, so they have the usual methods
+        self._client = hcloud.Client(token)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._api: AsyncHcloudClient = self._run(self._create_api(token))
+
+    @classmethod
+    def for_token(cls, token: str) -> "ApiFacade":
+        with cls._instances_lock:
+            if token not in cls._instances:
+                cls._instances[token] = cls(token)
+            return cls._instances[token]
+
+    @staticmethod
+    async def _create_api(token: str) -> AsyncHcloudClient:
+        return AsyncHcloudClient(token)
+
+    def _run(self, coro: Coroutine[Any, Any, T]) -> T:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _bind(self, kind: str, data: Dict[str, Any]) -> Any:
+        return BOUND_MODELS[kind](getattr(self._client, kind), data)
+
+    def get_by_id(self, kind: str, id_: int) -> Any:
+        return self._bind(kind, self._run(self._api.get_by_id(kind, id_)))
+
+    def get_by_name(self, kind: str, name: str) -> Optional[Any]:
+        data = self._run(self._api.get_by_name(kind, name))
+        return None if data is None else self._bind(kind, data)
+
+    def get_all(self, kind: str, params: Params = ()) -> List[Any]:
+        return [self._bind(kind, d) for d in self._run(self._api.get_all(kind, params))]
+
+    def get_many_by_name(self, kind: str, names: Sequence[str]) -> List[Optional[Any]]:
+        """Look up several entities concurrently, `None` for missing ones."""
+
+        async def get_many() -> List[Optional[Dict[str, Any]]]:
+            return await asyncio.gather(
+                *(self._api.get_by_name(kind, name) for name in names)
+            )
+
+        return [
+            None if data is None else self._bind(kind, data)
+            for data in self._run(get_many())
+        ]
+
+    def wait_for_actions(
+        self,
+        actions: Sequence[BoundAction],
+        callback: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Wait for all `actions`. `callback` is called from the event loop thread."""
+        self._run(self._api.wait_for_actions([a.id for a in actions], callback))
+
+    def close(self) -> None:
+        self._run(self._api.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+@atexit.register
+def _close_facades() -> None:
+    with ApiFacade._instances_lock:
+        for facade in ApiFacade._instances.values():
+            facade.close()
+        ApiFacade._instances.clear()
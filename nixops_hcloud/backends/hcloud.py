@@ -1,7 +1,12 @@
+import glob
 import os
 import os.path
-from typing import (Any, Iterable, List, Mapping, Optional, Sequence, Tuple,
-                    Union, cast)
+import subprocess
+import tempfile
+import threading
+from datetime import timedelta
+from typing import (AbstractSet, Any, Callable, Dict, FrozenSet, Iterable,
+                    List, Mapping, Optional, Sequence, Tuple, Union, cast)
 
 import yaml
 from nixops import known_hosts
@@ -9,20 +14,66 @@ from nixops.backends import MachineDefinition, MachineOptions, MachineState
 from nixops.nix_expr import RawValue, nix2py
 from nixops.resources import ResourceEval, ResourceOptions
 from nixops.util import attr_property, create_key_pair
-from nixops_hcloud.hcloud_util import HcloudContextOptions, get_access_token
+from nixops_hcloud.aio import ApiFacade
+from nixops_hcloud.hcloud_util import (HcloudContextOptions, closest_closure,
+                                       get_access_token)
+from nixops_hcloud.metrics import (MetricSummary, RateLimiter, Recommendation,
+                                   fetch_metrics, recommend_server_type,
+                                   summarize)
+from nixops_hcloud.operations import ATTACH, CHANGE_TYPE, DETACH, Operation
+from nixops_hcloud.resources.hcloud_network import HcloudNetworkState
 from nixops_hcloud.resources.hcloud_sshkey import HcloudSshKeyState
 from nixops_hcloud.resources.hcloud_volume import HcloudVolumeState
 
 import hcloud
 from hcloud.actions.client import BoundAction
+from hcloud.images.client import BoundImage
 from hcloud.images.domain import Image
+from hcloud.locations.domain import Location
+from hcloud.networks.domain import Network
+from hcloud.server_types.client import BoundServerType
 from hcloud.server_types.domain import ServerType
 from hcloud.servers.client import BoundServer
-from hcloud.servers.domain import Server
+from hcloud.servers.domain import CreateServerResponse, Server
 from hcloud.ssh_keys.domain import SSHKey
+from hcloud.volumes.client import BoundVolume
 from hcloud.volumes.domain import Volume
 
 HOST_KEY_TYPE = "ed25519"
+# Port of services.nix-serve, pinned by hcloud.nix when deployment.hcloud.serveClosures is enabled
+NIX_SERVE_PORT = 5000
+# Name of the nixops key holding the secret key nix-serve signs closures with, see hcloud.nix
+NIX_SERVE_KEY = "nix-serve-key"
+
+
+def closure_hash(store_path: str) -> str:
+    """Hash part of a Nix store path, short enough to be used as a label value."""
+    return os.path.basename(store_path).split("-", 1)[0]
+
+
+def create_signing_key(name: str) -> Tuple[str, str]:
+    """Generate a Nix binary cache signing key pair, returning the secret and public key."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        secret_file = os.path.join(tmpdir, "secret")
+        public_file = os.path.join(tmpdir, "public")
+        subprocess.check_call(
+            ["nix-store", "--generate-binary-cache-key", name, secret_file, public_file]
+        )
+        with open(secret_file) as secret, open(public_file) as public:
+            return secret.read().strip(), public.read().strip()
+
+
+def _local_closure(store_path: str) -> Optional[AbstractSet[str]]:
+    """Closure of `store_path` in the local store, `None` if it's not there."""
+    if not os.path.exists(store_path):
+        return None
+    try:
+        out = subprocess.check_output(
+            ["nix-store", "--query", "--requisites", store_path], text=True
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return frozenset(out.splitlines())
 
 
 class VolumeOptions(ResourceOptions):
@@ -31,15 +82,27 @@ class VolumeOptions(ResourceOptions):
     fileSystem: Mapping[str, Any]
 
 
+class StoreVolumeOptions(ResourceOptions):
+    enable: bool
+    size: int
+    mountPoint: str
+
+
 class HcloudVmOptions(HcloudContextOptions):
     image: Optional[int]
     # TODO validate image_selector
     image_selector: str
+    imageSelection: str
     location: str
+    fallbackLocations: Sequence[str]
     serverType: str
     upgradeDisk: bool
     sshKeys: Sequence[Union[str, ResourceEval]]
     volumes: Sequence[VolumeOptions]
+    networks: Sequence[Union[str, ResourceEval]]
+    serveClosures: bool
+    closureSeed: Optional[str]
+    storeVolume: StoreVolumeOptions
 
 
 class HcloudOptions(MachineOptions):
@@ -68,6 +131,14 @@ class HcloudState(MachineState[HcloudDefinition]):
     ssh_keys = attr_property("hcloud.sshKeys", None, "json")
     volume_ids = attr_property("hcloud.volumeIds", None, "json")
     filesystems = attr_property("hcloud.filesystems", None, "json")
+    network_ids = attr_property("hcloud.networkIds", None, "json")
+    private_ips = attr_property("hcloud.privateIps", None, "json")
+    serve_closures = attr_property("hcloud.serveClosures", False, bool)
+    closure_seed = attr_property("hcloud.closureSeed", None, str)
+    closure_public_key = attr_property("hcloud.closurePublicKey", None, str)
+    _closure_secret_key = attr_property("hcloud.closureSecretKey", None, str)
+    store_volume_id = attr_property("hcloud.storeVolumeId", None, int)
+    store_volume_mount_point = attr_property("hcloud.storeVolumeMountPoint", None, str)
     _ssh_private_key = attr_property("hcloud.sshPrivateKey", None, str)
     _ssh_public_key = attr_property("hcloud.sshPublicKey", None, str)
     _public_host_key = attr_property("hcloud.publicHostKey", None, str)
@@ -76,6 +147,9 @@ class HcloudState(MachineState[HcloudDefinition]):
         super().__init__(*args, **kwargs)
         self._cached_client: Optional[hcloud.Client] = None
         self._cached_server: Optional[BoundServer] = None
+        # Serializes closure copies, so a seed receives the shared paths only once and
+        # copies don't race on the store volume
+        self._closure_lock = threading.Lock()
 
     @classmethod
     def get_type(cls) -> str:
@@ -92,12 +166,17 @@ class HcloudState(MachineState[HcloudDefinition]):
             self._cached_client = hcloud.Client(self.token)
         return self._cached_client
 
+    @property
+    def _api(self) -> ApiFacade:
+        assert self.token
+        return ApiFacade.for_token(self.token)
+
     @property
     def _server(self) -> BoundServer:
         if self.vm_id is None:
             raise Exception("Server not created yet")
         if self._cached_server is None or self._cached_server.id != self.vm_id:
-            self._cached_server = self._client.servers.get_by_id(self.vm_id)
+            self._cached_server = self._api.get_by_id("servers", self.vm_id)
         return cast(BoundServer, self._cached_server)
 
     def create(self, defn: HcloudDefinition, check, allow_reboot, allow_recreate):
@@ -109,18 +188,33 @@ class HcloudState(MachineState[HcloudDefinition]):
 
         self.set_common_state(defn)
         self.upgrade_disk = hetzner.upgradeDisk
+        self.serve_closures = hetzner.serveClosures
+        if self.serve_closures and self._closure_secret_key is None:
+            self.log("Generating closure signing key...")
+            (self._closure_secret_key, self.closure_public_key) = create_signing_key(
+                f"nixops-{self.depl.uuid}-{self.name}"
+            )
+        self.closure_seed = self._check_closure_seed(hetzner.closureSeed)
 
         # TODO maybe bootstrap can be automated with vncdotool
-        image_id = self._fetch_image_id(hetzner.image, hetzner.image_selector)
+        closure_aware = hetzner.imageSelection == "closure"
+        if closure_aware and self.image_id is not None:
+            # Re-selecting would just flag every newly baked image as a change
+            image_id = self.image_id
+        else:
+            image_id = self._fetch_image_id(
+                hetzner.image, hetzner.image_selector, closure_aware
+            )
         if self.image_id is None:
             self.image_id = image_id
         elif self.image_id != image_id:
             self.warn(
                 f"image_id changed from {self.image_id} to {image_id} but can't update image of a VM."
             )
-        if self.location is None:
-            self.location = hetzner.location
-        elif self.location != hetzner.location:
+        locations = [hetzner.location] + [
+            loc for loc in hetzner.fallbackLocations if loc != hetzner.location
+        ]
+        if self.location is not None and self.location not in locations:
             self.warn(
                 f"location changed from {self.location} to {hetzner.location} but can't update location of a VM."
             )
@@ -136,11 +230,12 @@ class HcloudState(MachineState[HcloudDefinition]):
                 )
             if do_upgrade:
                 self.log_start("Changing Hetzner server type...")
-                self._server.shutdown().wait_until_finished()
+                self._api.wait_for_actions([self._server.shutdown()])
                 self.wait_for_down(callback=lambda: self.log_continue("."))
-                self._server.change_type(
+                action = self._server.change_type(
                     ServerType(name=hetzner.serverType), upgrade_disk=self.upgrade_disk
-                ).wait_until_finished()
+                )
+                self._api.wait_for_actions([action])
                 self._server.power_on()
                 self.wait_for_up(callback=lambda: self.log_continue("."))
                 self.log_end("")
@@ -153,14 +248,17 @@ class HcloudState(MachineState[HcloudDefinition]):
             self.logger.warn(f"SSH keys cannot be changed after the server is created.")
 
         volume_ids = []
+        volume_locations = {}
         filesystems = {}
+        volume_models = self._lookup("volumes", [v.volume for v in hetzner.volumes])
         for volumeopts in hetzner.volumes:
             volume = volumeopts.volume
             if isinstance(volume, str):
-                volume_model = self._client.volumes.get_by_name(volume)
+                volume_model = volume_models[volume]
                 volume_name = volume
                 volume_id = volume_model.id
                 volume_loc = volume_model.location.name
+                volume_format = volume_model.format
             else:
                 volume_res = self.depl.get_typed_resource(
                     volume._name, "hcloud-volume", HcloudVolumeState
@@ -169,16 +267,58 @@ class HcloudState(MachineState[HcloudDefinition]):
                 volume_id = volume_res.hcloud_id
                 assert volume_id is not None
                 volume_loc = volume_res.location
-            if volume_loc != self.location:
+                volume_format = volume_res.fs_format
+            if self.location is not None and volume_loc != self.location:
                 raise Exception(
                     f"Volume {volume_name!r} is in a different location from server {self.name!r}"
                 )
+            volume_locations[volume_name] = volume_loc
             volume_ids.append(volume_id)
             if volumeopts.mountPoint is not None:
                 fs = dict(volumeopts.fileSystem)
                 fs["device"] = f"/dev/disk/by-id/scsi-0HC_Volume_{volume_id}"
+                if volume_format is not None:
+                    self._use_volume_format(volume_name, volume_format, fs)
                 filesystems[volumeopts.mountPoint] = fs
 
+        # The store volume outlives the server, so it's looked up by name instead of by the
+        # recorded id
+        store = hetzner.storeVolume
+        store_volume: Optional[BoundVolume] = None
+        if store.enable:
+            store_volume = self._find_store_volume()
+            if store_volume is None and self.vm_id is not None:
+                store_volume = self._create_store_volume(store.size)
+            if store_volume is not None:
+                store_loc = store_volume.location.name
+                if self.location is not None and store_loc != self.location:
+                    raise Exception(
+                        f"Store volume of {self.name!r} is in a different location from the server"
+                    )
+                if store.size > store_volume.size:
+                    self.log(f"resizing store volume to {store.size}GB...")
+                    self._api.wait_for_actions([store_volume.resize(store.size)])
+                    server = store_volume.server
+                    if server is not None and server.id == self.vm_id:
+                        self._grow_store_filesystem(store_volume.id, store.mountPoint)
+                volume_locations[store_volume.name] = store_loc
+                volume_ids.append(store_volume.id)
+                filesystems[store.mountPoint] = self._store_filesystem(store_volume.id)
+        self.store_volume_id = None if store_volume is None else store_volume.id
+        self.store_volume_mount_point = store.mountPoint if store.enable else None
+
+        network_ids = []
+        network_models = self._lookup("networks", hetzner.networks)
+        for network in hetzner.networks:
+            if isinstance(network, str):
+                network_ids.append(network_models[network].id)
+            else:
+                network_res = self.depl.get_typed_resource(
+                    network._name, "hcloud-network", HcloudNetworkState
+                )
+                assert network_res.hcloud_id is not None
+                network_ids.append(network_res.hcloud_id)
+
         has_priv = self._ssh_private_key is not None
         has_pub = self._ssh_public_key is not None
         assert has_priv == has_pub
@@ -191,35 +331,54 @@ class HcloudState(MachineState[HcloudDefinition]):
                 new = set(volume_ids)
                 volumes_client = self._client.volumes
                 self.log_start("Updating volumes...")
+                # Actions lock the server, so they run one at a time
                 for v in current - new:
-                    volumes_client.detach(Volume(id=v))
+                    self._api.wait_for_actions([volumes_client.detach(Volume(id=v))])
                     self.log_continue(".")
                 for v in new - current:
-                    volumes_client.attach(
+                    action = volumes_client.attach(
                         Volume(id=v), self._server, automount=False
-                    ).wait_until_finished()
+                    )
+                    self._api.wait_for_actions([action])
                     self.log_continue(".")
                 self.log_end("")
                 self.volume_ids = volume_ids
+            if (self.network_ids or []) != network_ids:
+                current = set(self.network_ids or [])
+                new = set(network_ids)
+                self.log_start("Updating networks...")
+                for n in current - new:
+                    action = self._server.detach_from_network(Network(id=n))
+                    self._api.wait_for_actions([action])
+                    self.log_continue(".")
+                for n in new - current:
+                    action = self._server.attach_to_network(Network(id=n))
+                    self._api.wait_for_actions([action])
+                    self.log_continue(".")
+                self.log_end("")
+                self.network_ids = network_ids
+                self._update_private_ips()
         else:
-            self.log_start(
-                "Creating Hetzner Cloud VM ("
-                + f"image '{image_id}', type '{hetzner.serverType}', location '{hetzner.location}'"
-                + ")..."
-            )
-            response = self._client.servers.create(
-                name=self.name,
-                ssh_keys=[SSHKey(name=k) for k in ssh_keys],
-                volumes=[Volume(id=v) for v in volume_ids],
-                server_type=ServerType(self.server_type),
-                image=Image(id=self.image_id),
-                # Set labels so we can find the instance if nixops crashes before writing vm_id
-                labels=dict(self._server_labels()),
-                user_data=None
-                if self._ssh_public_key is None
-                else yaml.dump({"public-keys": [self._ssh_public_key]}),
+            def create_server(location: str) -> CreateServerResponse:
+                return self._client.servers.create(
+                    name=self.name,
+                    ssh_keys=[SSHKey(name=k) for k in ssh_keys],
+                    volumes=[Volume(id=v) for v in volume_ids],
+                    networks=[Network(id=n) for n in network_ids],
+                    server_type=ServerType(self.server_type),
+                    image=Image(id=self.image_id),
+                    location=Location(name=location),
+                    # Set labels so we can find the instance if nixops crashes before writing
+                    # vm_id
+                    labels=dict(self._server_labels()),
+                    user_data=None
+                    if self._ssh_public_key is None
+                    else yaml.dump({"public-keys": [self._ssh_public_key]}),
+                )
+
+            self.location, response = self._create_server(
+                locations, volume_locations, image_id, hetzner.serverType, create_server
             )
-            self.log_end("")
             self.public_ipv4 = response.server.public_net.ipv4.ip
             self.log_start("waiting for SSH...")
             self.wait_for_up(callback=lambda: self.log_continue("."))
@@ -230,10 +389,79 @@ class HcloudState(MachineState[HcloudDefinition]):
                 self.state = MachineState.STARTING
                 self.ssh_keys = ssh_keys
                 self.volume_ids = volume_ids
+                self.network_ids = network_ids
+                self._update_private_ips()
                 self._detect_hardware()
                 self._update_host_keys()
+            if store.enable and store_volume is None:
+                # Created now that the server's location is known
+                store_volume = self._create_store_volume(store.size)
+                action = self._client.volumes.attach(
+                    store_volume, self._server, automount=False
+                )
+                self._api.wait_for_actions([action])
+                self.volume_ids = volume_ids + [store_volume.id]
+                self.store_volume_id = store_volume.id
+                filesystems[store.mountPoint] = self._store_filesystem(store_volume.id)
         self.filesystems = filesystems
 
+    def plan(self, defn: HcloudDefinition) -> List[Operation]:
+        """Changes `create` would make to the existing server, see `nixops_hcloud.plan`."""
+        hetzner = defn.config.hcloud
+        ops = []
+
+        def op(
+            kind: str, description: str, depends_on: FrozenSet[str] = frozenset()
+        ) -> None:
+            ops.append(Operation(kind, self.name, self.get_type(), description, depends_on))
+
+        if hetzner.serverType != self.server_type:
+            op(CHANGE_TYPE, f"{self.server_type} -> {hetzner.serverType}")
+        store = hetzner.storeVolume
+        if store.enable and self.store_volume_id is None:
+            op(ATTACH, f"store volume ({store.size}GB, created if missing)")
+        # The store volume is attached by `create` itself
+        volume_ids = [
+            v
+            for v in self.volume_ids or []
+            if not (hetzner.storeVolume.enable and v == self.store_volume_id)
+        ]
+        for kind, current, wanted in [
+            (
+                "volume",
+                volume_ids,
+                self._plan_ids([v.volume for v in hetzner.volumes], "volumes"),
+            ),
+            ("network", self.network_ids, self._plan_ids(hetzner.networks, "networks")),
+        ]:
+            current_ids = set(current or [])
+            wanted_ids = {i for _, i, _ in wanted}
+            for i in sorted(current_ids - wanted_ids):
+                op(DETACH, f"{kind} {i}")
+            for name, i, deps in wanted:
+                if i is None or i not in current_ids:
+                    op(ATTACH, f"{kind} {name}", deps)
+        return ops
+
+    def _plan_ids(
+        self, refs: Sequence[Any], kind: str
+    ) -> List[Tuple[str, Optional[int], FrozenSet[str]]]:
+        """Resolve volume or network references to (name, id, dependencies).
+
+        The id is `None` for resources of this deployment which haven't been created yet.
+        """
+        models = self._lookup(kind, refs)
+        resolved = []
+        for ref in refs:
+            if isinstance(ref, str):
+                resolved.append((ref, models[ref].id, frozenset()))
+            else:
+                res = self.depl.resources.get(ref._name)
+                resolved.append(
+                    (ref._name, getattr(res, "hcloud_id", None), frozenset({ref._name}))
+                )
+        return resolved
+
     def destroy(self, wipe=False):
         if self.vm_id is None:
             return True
@@ -249,6 +477,89 @@ class HcloudState(MachineState[HcloudDefinition]):
         self._reset()
         return True
 
+    def bake_image(
+        self, role: Optional[str] = None, labels: Optional[Mapping[str, str]] = None
+    ) -> int:
+        """Snapshot the server into an image `image_selector` can find.
+
+        The image is labeled with `nixops`, the machine role (defaults to the machine name) and the
+        hash of the running system closure, and its description is the system store path. Servers
+        created from it start with that closure already in their store.
+
+        Raises
+        ------
+        `Exception`
+            If the server mounts volumes without the `nofail` option, since servers created from
+            the image would wait for them at boot and fail, or if it doesn't run
+            fetch-hetzner-keys, since they would only accept this server's SSH keys.
+        """
+        blocking = sorted(
+            mount_point
+            for mount_point, fs in (self.filesystems or {}).items()
+            if "nofail" not in fs.get("options", [])
+        )
+        if blocking:
+            raise Exception(
+                f"{self.name!r} mounts volumes on {', '.join(blocking)} without the nofail option, "
+                + "servers created from its image would fail to boot without them"
+            )
+        if self.run_command("systemctl cat fetch-hetzner-keys.service", check=False) != 0:
+            raise Exception(
+                f"{self.name!r} doesn't enable services.fetchHetznerKeys, servers created from "
+                + "its image wouldn't accept their SSH keys"
+            )
+        system = str(
+            self.run_command("readlink -f /run/current-system", capture_stdout=True)
+        ).strip()
+        image_labels = {
+            "nixops": "",
+            "nixops/role": role or self.name,
+            "nixops/closure": closure_hash(system),
+        }
+        image_labels.update(labels or {})
+        self.run_command("sync")
+        self.log_start(f"creating image of {system}...")
+        response = self._server.create_image(
+            description=system, type="snapshot", labels=image_labels
+        )
+        self._api.wait_for_actions(
+            [response.action], callback=lambda: self.log_continue(".")
+        )
+        self.log_end(f"created image {response.image.id}")
+        return response.image.id
+
+    def rightsize(
+        self,
+        window: timedelta,
+        limiter: RateLimiter,
+        catalogs: Dict[str, Sequence[BoundServerType]],
+    ) -> Tuple[Dict[str, MetricSummary], Recommendation]:
+        """Summarize the server's utilization over `window` and recommend a server type.
+
+        `catalogs` caches the server type catalog per API token across machines.
+        """
+        assert self.vm_id is not None
+        summary = summarize(fetch_metrics(self._client, self.vm_id, window, limiter))
+        if self.token not in catalogs:
+            limiter.wait()
+            catalogs[self.token] = self._client.server_types.get_all()
+        catalog = catalogs[self.token]
+        current = next((t for t in catalog if t.name == self.server_type), None)
+        if current is None:
+            raise Exception(
+                f"Server type {self.server_type!r} of {self.name!r} isn't in the Hetzner Cloud catalog"
+            )
+        limiter.wait()
+        server = self._client.servers.get_by_id(self.vm_id)
+        cpu = summary.get("cpu")
+        recommendation = recommend_server_type(
+            current,
+            catalog,
+            cpu_p95=None if cpu is None else cpu.percentiles[95],
+            disk_size=server.primary_disk_size,
+        )
+        return summary, recommendation
+
     def get_ssh_flags(self, *args, **kwargs) -> List[str]:
         key_file = self.get_ssh_private_key_file()
         assert key_file is not None
@@ -282,6 +593,63 @@ class HcloudState(MachineState[HcloudDefinition]):
         assert self.public_ipv4
         return self.public_ipv4
 
+    def copy_closure_to(self, path):
+        seed = self._get_closure_seed()
+        if seed is not None:
+            # Only the upload, the seed's store volume caches the seed's own closure
+            seed._upload_closure(path)
+        # Parallel copies would race mounting and pruning the store volume
+        with self._closure_lock:
+            substituters: List[Tuple[str, str]] = []
+            store_cache = self._store_cache_url()
+            if store_cache is not None:
+                # Not mounted by NixOS yet on the first deploy
+                mount_point = self.store_volume_mount_point
+                device = self._store_filesystem(self.store_volume_id)["device"]
+                self.run_command(
+                    f"mkdir -p {mount_point} && "
+                    + f"{{ mountpoint -q {mount_point} || mount {device} {mount_point}; }}"
+                )
+                # Only root can write to the volume, and paths built on the deployer are
+                # unsigned
+                substituters.append((store_cache, "--option require-sigs false"))
+            if seed is not None:
+                substituters.append(
+                    (
+                        f"http://{self._shared_private_ip(seed)}:{NIX_SERVE_PORT}",
+                        f"--option trusted-public-keys '{seed.closure_public_key}'",
+                    )
+                )
+            for substituter, options in substituters:
+                self.log(f"substituting closure from {substituter}...")
+                self.run_command(
+                    f"nix-store -j 4 -r {path} "
+                    + f"--option substituters '{substituter}' {options}",
+                    check=False,
+                )
+            # Copies whatever couldn't be substituted straight from the deployer
+            super().copy_closure_to(path)
+            if store_cache is not None:
+                self.log("saving closure to the store volume...")
+                self._prune_store_cache(path)
+                status = self.run_command(
+                    "nix --option experimental-features nix-command "
+                    + f"copy --to '{store_cache}' {path}",
+                    check=False,
+                )
+                if status != 0:
+                    self.warn(
+                        "couldn't save the closure to the store volume, it may be too small"
+                    )
+
+    def _upload_closure(self, path: str) -> None:
+        """Copy the closure of `path` from the deployer, without touching the store volume.
+
+        Used by the machines this one seeds, so it receives their shared paths only once.
+        """
+        with self._closure_lock:
+            super().copy_closure_to(path)
+
     def get_physical_spec(self):
         spec = super().get_physical_spec()
         if self.hw_info:
@@ -289,13 +657,22 @@ class HcloudState(MachineState[HcloudDefinition]):
         if self.filesystems is not None:
             fs = spec.setdefault("config", {}).setdefault("fileSystems", {})
             fs.update(self.filesystems)
+        if self.serve_closures and self._closure_secret_key is not None:
+            keys = (
+                spec.setdefault("config", {})
+                .setdefault("deployment", {})
+                .setdefault("keys", {})
+            )
+            keys[NIX_SERVE_KEY] = {"text": self._closure_secret_key, "user": "nix-serve"}
         return spec
 
     def _check(self, res):
         self.log_start("Looking up server...")
         if self.vm_id is None:
             label_selector = ",".join(f"{k}={v}" for k, v in self._server_labels())
-            servers, _ = self._client.servers.get_list(label_selector=label_selector,)
+            servers = self._api.get_all(
+                "servers", [("label_selector", label_selector)]
+            )
             if len(servers) > 1:
                 self.warn(f"Multiple servers matching {self.name} by labels")
             if len(servers) == 0:
@@ -306,7 +683,7 @@ class HcloudState(MachineState[HcloudDefinition]):
             self.vm_id = server.id
         else:
             try:
-                server = self._client.servers.get_by_id(self.vm_id)
+                server = self._api.get_by_id("servers", self.vm_id)
             except hcloud.APIException as e:
                 if e.code == "not_found":
                     self.log_end("not found")
@@ -323,6 +700,8 @@ class HcloudState(MachineState[HcloudDefinition]):
             self.state = self._hcloud_status_to_machine_status(server.status)
             self.image_id = server.image.id
             self.volume_ids = [v.id for v in server.volumes]
+            self.network_ids = [n.network.id for n in server.private_net]
+            self.private_ips = {str(n.network.id): n.ip for n in server.private_net}
             self.location = server.datacenter.location.name
             self.public_ipv4 = server.public_net.ipv4.ip
             self.server_type = server.server_type.name
@@ -334,9 +713,160 @@ class HcloudState(MachineState[HcloudDefinition]):
         return {
             r
             for r in resources
-            if isinstance(r, (HcloudSshKeyState, HcloudVolumeState))
+            if isinstance(
+                r, (HcloudSshKeyState, HcloudVolumeState, HcloudNetworkState)
+            )
         }
 
+    def _lookup(self, kind: str, refs: Sequence[Any]) -> Dict[str, Any]:
+        """Look up the entities `refs` refer to by name concurrently, keyed by name.
+
+        References to resources of this deployment are skipped.
+        """
+        names = [ref for ref in refs if isinstance(ref, str)]
+        models = dict(zip(names, self._api.get_many_by_name(kind, names)))
+        for name, model in models.items():
+            if model is None:
+                raise Exception(f"{kind[:-1].capitalize()} {name!r} not found")
+        return models
+
+    def _store_volume_name(self) -> str:
+        # Can't collide with the default name of an hcloud-volume, nixops-<uuid>-<name>
+        return f"nixops-store-{self.depl.uuid}-{self.name}"
+
+    def _store_volume_labels(self) -> Dict[str, str]:
+        return dict(self._server_labels(), **{"nixops/store": ""})
+
+    def _find_store_volume(self) -> Optional[BoundVolume]:
+        label_selector = ",".join(
+            f"{k}={v}" if v else k for k, v in self._store_volume_labels().items()
+        )
+        volumes = self._api.get_all("volumes", [("label_selector", label_selector)])
+        if len(volumes) > 1:
+            self.warn(f"Multiple store volumes matching {self.name} by labels")
+        return volumes[0] if volumes else None
+
+    def _create_store_volume(self, size: int) -> BoundVolume:
+        assert self.location is not None
+        self.log_start("creating store volume...")
+        response = self._client.volumes.create(
+            size=size,
+            name=self._store_volume_name(),
+            location=Location(name=self.location),
+            format="ext4",
+            labels=self._store_volume_labels(),
+        )
+        self._api.wait_for_actions([response.action])
+        self.log_end("")
+        return response.volume
+
+    @staticmethod
+    def _store_filesystem(volume_id: int) -> Dict[str, Any]:
+        return {
+            "device": f"/dev/disk/by-id/scsi-0HC_Volume_{volume_id}",
+            "fsType": "ext4",
+            # Grows the filesystem if the volume was resized while the server was down
+            "autoResize": True,
+            "options": ["nofail"],
+        }
+
+    def _grow_store_filesystem(self, volume_id: int, mount_point: str) -> None:
+        """Grow the store volume's filesystem to the size of the resized volume."""
+        device = self._store_filesystem(volume_id)["device"]
+        status = self.run_command(
+            f"if mountpoint -q {mount_point}; then resize2fs {device}; "
+            + f"else e2fsck -fp {device}; resize2fs {device}; fi",
+            check=False,
+        )
+        if status != 0:
+            self.warn(
+                "couldn't grow the store volume's filesystem, it's grown when next mounted"
+            )
+
+    def _prune_store_cache(self, path: str) -> None:
+        """Remove everything outside the closure of `path` from the store volume's cache.
+
+        `path` must already be in the server's store. Keeping only the deployed closure bounds the
+        cache to the size of one system.
+        """
+        self.run_command(
+            f"cd {self.store_volume_mount_point} && "
+            + f"nix-store --query --requisites {path} "
+            + "| sed 's|^/nix/store/\\([^-]*\\)-.*|\\1.narinfo|' | sort > .keep && "
+            + "find . -maxdepth 1 -name '*.narinfo' -printf '%f\\n' "
+            + "| sort | comm -23 - .keep | xargs -r rm -f && "
+            + "find . -maxdepth 1 -name '*.narinfo' -exec sed -n 's/^URL: //p' {} + "
+            + "| sort > .keep && "
+            + "{ find nar -type f 2>/dev/null | sort | comm -23 - .keep | xargs -r rm -f; }; "
+            + "rm -f .keep",
+            check=False,
+        )
+
+    def _store_cache_url(self) -> Optional[str]:
+        """Binary cache on the store volume, see `deployment.hcloud.storeVolume`."""
+        if self.store_volume_id is None or self.store_volume_mount_point is None:
+            return None
+        return f"file://{self.store_volume_mount_point}?compression=none"
+
+    def _update_private_ips(self) -> None:
+        assert self.vm_id is not None
+        server = self._api.get_by_id("servers", self.vm_id)
+        self._cached_server = server
+        self.private_ips = {str(n.network.id): n.ip for n in server.private_net}
+
+    def _shared_private_ip(self, other: "HcloudState") -> Optional[str]:
+        """Private IP of `other` in a network both machines are attached to."""
+        own = self.private_ips or {}
+        for network_id, ip in (other.private_ips or {}).items():
+            if network_id in own:
+                return ip
+        return None
+
+    def _check_closure_seed(self, name: Optional[str]) -> Optional[str]:
+        """`name` if it's a machine of this deployment with serveClosures enabled, else `None`."""
+        if name is None or name == self.name:
+            return name
+        seed = (self.depl.definitions or {}).get(name)
+        if not isinstance(seed, HcloudDefinition):
+            self.warn(
+                f"closure seed {name!r} isn't a Hetzner Cloud machine of this deployment, "
+                + "closures will be copied directly"
+            )
+            return None
+        if not seed.config.hcloud.serveClosures:
+            self.warn(
+                f"closure seed {name!r} doesn't have serveClosures enabled, "
+                + "closures will be copied directly"
+            )
+            return None
+        return name
+
+    def _get_closure_seed(self) -> Optional["HcloudState"]:
+        if self.closure_seed is None or self.closure_seed == self.name:
+            return None
+        seed = self.depl.resources.get(self.closure_seed)
+        if (
+            not isinstance(seed, HcloudState)
+            or not seed.serve_closures
+            or seed.closure_public_key is None
+        ):
+            self.warn(
+                f"closure seed {self.closure_seed!r} isn't serving closures, copying closure directly"
+            )
+            return None
+        if seed.closure_seed not in (None, seed.name):
+            self.warn(
+                f"closure seed {seed.name!r} has a seed itself, copying closure directly"
+            )
+            return None
+        if self._shared_private_ip(seed) is None:
+            self.warn(
+                f"closure seed {seed.name!r} shares no private network with {self.name!r}, "
+                + "copying closure directly"
+            )
+            return None
+        return seed
+
     def _detect_hardware(self) -> None:
         self.log_start("detecting hardware...")
         cmd = "nixos-generate-config --show-hardware-config"
@@ -375,18 +905,156 @@ class HcloudState(MachineState[HcloudDefinition]):
         except KeyError as e:
             raise Exception(f"Invalid server status {status!r}") from e
 
-    def _fetch_image_id(self, image: Optional[int], image_selector: str) -> int:
+    def _create_server(
+        self,
+        locations: Sequence[str],
+        volume_locations: Dict[str, str],
+        image_id: int,
+        server_type: str,
+        create: Callable[[str], CreateServerResponse],
+    ) -> Tuple[str, CreateServerResponse]:
+        """Create the server with `create` in the first of `locations` that has capacity.
+
+        Returns the location and the creation response.
+        """
+        # Volumes can't move, so they pin the server to their location
+        candidates = [
+            loc for loc in locations if all(loc == v for v in volume_locations.values())
+        ]
+        if not candidates:
+            raise Exception(
+                f"Volumes of server {self.name!r} aren't in any of its locations: "
+                + ", ".join(f"{k!r} in {v}" for k, v in volume_locations.items())
+            )
+        candidates = self._order_by_availability(candidates, server_type)
+        for i, location in enumerate(candidates):
+            self.log_start(
+                "Creating Hetzner Cloud VM ("
+                + f"image '{image_id}', type '{server_type}', location '{location}'"
+                + ")..."
+            )
+            try:
+                response = create(location)
+            except hcloud.APIException as e:
+                if e.code != "resource_unavailable" or i == len(candidates) - 1:
+                    raise
+                self.log_end("unavailable")
+                continue
+            self.log_end("")
+            return location, response
+        raise AssertionError("unreachable")
+
+    def _order_by_availability(
+        self, locations: Sequence[str], server_type: str
+    ) -> List[str]:
+        """Move locations where `server_type` is currently unavailable to the end.
+
+        They're kept as a last resort since availability can change before the server is created.
+        """
+        if len(locations) <= 1:
+            return list(locations)
+        server_type_model = self._api.get_by_name("server_types", server_type)
+        if server_type_model is None:
+            raise Exception(f"Server type {server_type!r} not found")
+        available = {
+            dc.location.name
+            for dc in self._api.get_all("datacenters")
+            if any(t.id == server_type_model.id for t in dc.server_types.available)
+        }
+        unavailable = [loc for loc in locations if loc not in available]
+        if unavailable:
+            self.log(
+                f"server type {server_type} unavailable in {', '.join(unavailable)}"
+            )
+        return [loc for loc in locations if loc in available] + unavailable
+
+    def _fetch_image_id(
+        self, image: Optional[int], image_selector: str, closure_aware: bool = False
+    ) -> int:
         if image is None:
             self.log(f"Finding image matching {image_selector}...")
-            matches, _ = self._client.images.get_list(
-                label_selector=image_selector, sort="created:desc",
+            matches = self._api.get_all(
+                "images",
+                [("label_selector", image_selector), ("sort", "created:desc")],
             )
             if len(matches) == 0:
                 raise Exception(f"No images found matching {image_selector}")
+            if closure_aware and len(matches) > 1:
+                target = self._target_closure(image_selector)
+                if target is None:
+                    self.log("target closure unknown, using newest image")
+                    return matches[0].id
+                best = closest_closure(
+                    [(m.id, self._image_closure(m)) for m in matches], target
+                )
+                if best is None:
+                    self.log("no image has a known closure, using newest image")
+                    return matches[0].id
+                image_id, missing = best
+                self.log(f"using image {image_id}, {missing} store paths missing")
+                return image_id
             return matches[0].id
         else:
             return image
 
+    def _target_closure(self, image_selector: str) -> Optional[AbstractSet[str]]:
+        """Closure of the system this machine is going to run, as far as the deployer knows.
+
+        nixops creates machines before building them, so that's the currently deployed system when
+        recreating a server, else the result of an earlier build of this deployment, e.g. with
+        `nixops deploy --build-only`. A new machine has neither, so it falls back to the system of
+        a deployed machine using the same `image_selector`, usually another machine of its role.
+        """
+        toplevels = [self.cur_toplevel]
+        if self.depl.configs_path is not None:
+            built = os.path.join(self.depl.configs_path, self.name)
+            if os.path.exists(built):
+                toplevels.append(os.path.realpath(built))
+        definitions = self.depl.definitions or {}
+        for name, machine in sorted(self.depl.active_machines.items()):
+            defn = definitions.get(name)
+            if (
+                name != self.name
+                and isinstance(machine, HcloudState)
+                and isinstance(defn, HcloudDefinition)
+                and defn.config.hcloud.image_selector == image_selector
+            ):
+                toplevels.append(machine.cur_toplevel)
+        for toplevel in toplevels:
+            if toplevel is not None:
+                closure = _local_closure(toplevel)
+                if closure is not None:
+                    return closure
+        return None
+
+    @staticmethod
+    def _image_closure(image: BoundImage) -> Optional[AbstractSet[str]]:
+        """Closure of the system baked into `image`, see `bake_image`."""
+        system = image.description or ""
+        if not system.startswith("/nix/store/"):
+            system_hash = (image.labels or {}).get("nixops/closure")
+            if not system_hash:
+                return None
+            paths = glob.glob(f"/nix/store/{glob.escape(system_hash)}-*")
+            if len(paths) != 1:
+                return None
+            system = paths[0]
+        return _local_closure(system)
+
+    def _use_volume_format(
+        self, volume_name: str, volume_format: str, fs: dict
+    ) -> None:
+        """Mount a volume that Hetzner already formatted without formatting it on the host."""
+        fs_type = fs.setdefault("fsType", volume_format)
+        if fs_type != volume_format:
+            self.warn(
+                f"volume {volume_name!r} is formatted as {volume_format} but mounted as {fs_type}"
+            )
+        elif fs.pop("autoFormat", False):
+            self.log(
+                f"volume {volume_name!r} is already formatted as {volume_format}, skipping autoFormat"
+            )
+
     def _server_labels(self) -> Iterable[Tuple[str, str]]:
         assert self.depl
         yield "nixops/name", self.name
@@ -404,6 +1072,8 @@ class HcloudState(MachineState[HcloudDefinition]):
             self.public_ipv4 = None
             self.server_type = None
             self.hw_info = None
+            self.private_ips = None
+            self.serve_closures = False
             self._ssh_public_key = None
             self._ssh_private_key = None
             self._public_host_key = None
@@ -1,4 +1,4 @@
-from typing import Generic, Optional, Protocol, TypeVar
+from typing import Generic, Optional, Protocol, Sequence, TypeVar
 
 import hcloud
 from hcloud.actions.client import BoundAction
@@ -6,6 +6,7 @@ from hcloud.core.client import BoundModelBase, ClientEntityBase
 from nixops.deployment import Deployment
 from nixops.resources import ResourceDefinition, ResourceState
 
+from nixops_hcloud.aio import ApiFacade
 from nixops_hcloud.hcloud_util import HcloudContextOptions, get_access_token
 
 BoundModelType = TypeVar("BoundModelType", bound=BoundModelBase)
@@ -23,6 +24,8 @@ class HcloudDefinition(Protocol):
 
 
 class EntityResource(Protocol, Generic[ResourceDefinitionType_contra, BoundModelType]):
+    # Kind of entity in the API, e.g. "volumes"
+    api_kind: str
     state: int
     token: str
     hcloud_id: Optional[int]
@@ -96,7 +99,7 @@ def entity_destroy(
         return True
     resp = model.delete()
     if isinstance(resp, BoundAction):
-        resp.wait_until_finished()
+        entity_wait(res, [resp])
         return True
     return resp
 
@@ -120,7 +123,7 @@ def get_by_name(
 ) -> Optional[BoundModelType]:
     res.log_start(f"looking up {res.show_type()}...")
     try:
-        model = res.entity_client().get_by_name(res.hcloud_name)  # type: ignore
+        model = ApiFacade.for_token(res.token).get_by_name(res.api_kind, res.hcloud_name)
         if model is not None:
             res.log_end(f"found {model.id}")
             return model
@@ -129,3 +132,11 @@ def get_by_name(
             raise
     res.log_end("not found")
     return None
+
+
+def entity_wait(
+    res: EntityResource[ResourceDefinitionType_contra, BoundModelType],
+    actions: Sequence[BoundAction],
+) -> None:
+    """Wait for `actions` on the event loop shared by all resources using the same token."""
+    ApiFacade.for_token(res.token).wait_for_actions(actions)
@@ -1,11 +1,13 @@
 import os
 import os.path
 from dataclasses import dataclass
-from typing import Mapping, Optional
+from typing import AbstractSet, Mapping, Optional, Sequence, Tuple, TypeVar
 
 import toml
 from nixops.resources import ResourceOptions
 
+T = TypeVar("T")
+
 
 class AccessTokenException(Exception):
     pass
@@ -88,3 +90,22 @@ def get_access_token(
         raise AccessTokenException(
             "Need to be in an hcloud context or have hcloud token or context explicitly set."
         ) from e
+
+
+def closest_closure(
+    candidates: Sequence[Tuple[T, Optional[AbstractSet[str]]]], target: AbstractSet[str]
+) -> Optional[Tuple[T, int]]:
+    """Pick the candidate whose closure is missing the fewest store paths of `target`.
+
+    Candidates with an unknown closure (`None`) are skipped and ties go to the earliest candidate,
+    so callers should order them by preference. Returns the chosen key along with the number of
+    paths that would still need to be copied, or `None` if no candidate has a known closure.
+    """
+    best: Optional[Tuple[T, int]] = None
+    for key, closure in candidates:
+        if closure is None:
+            continue
+        missing = len(target - closure)
+        if best is None or missing < best[1]:
+            best = (key, missing)
+    return best
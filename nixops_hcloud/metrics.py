@@ -0,0 +1,167 @@
+"""Server utilization metrics and server type recommendations."""
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Mapping, Optional, Sequence
+
+import hcloud
+from hcloud.server_types.client import BoundServerType
+
+PERCENTILES = (50, 95, 99)
+
+# Summarized metric name -> Hetzner time series summed into it
+SERIES: Mapping[str, Sequence[str]] = {
+    "cpu": ["cpu"],
+    "disk_iops": ["disk.0.iops.read", "disk.0.iops.write"],
+    "disk_bandwidth": ["disk.0.bandwidth.read", "disk.0.bandwidth.write"],
+    "network_pps": ["network.0.pps.in", "network.0.pps.out"],
+    "network_bandwidth": ["network.0.bandwidth.in", "network.0.bandwidth.out"],
+}
+
+# Most data points the API returns per series, used to pick the step
+MAX_POINTS = 500
+
+
+class RateLimiter:
+    """Spaces out API calls so they stay under Hetzner's request rate limit (3600/h)."""
+
+    def __init__(self, min_interval: float = 1.0) -> None:
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            delay = self._last + self.min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._last = time.monotonic()
+
+
+def fetch_metrics(
+    client: hcloud.Client,
+    server_id: int,
+    window: timedelta,
+    limiter: RateLimiter,
+    end: Optional[datetime] = None,
+    retries: int = 5,
+) -> Dict[str, List[float]]:
+    """Fetch all cpu, disk and network time series of a server over `window` in a single call.
+
+    Retries with exponential backoff when the rate limit is exceeded. Returns the values of every
+    series returned by the API, keyed by series name.
+    """
+    end = end or datetime.now(timezone.utc)
+    start = end - window
+    step = max(60, int(window.total_seconds()) // MAX_POINTS)
+    params = {
+        "type": "cpu,disk,network",
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "step": step,
+    }
+    for attempt in range(retries):
+        limiter.wait()
+        try:
+            resp = client.request(
+                url=f"/servers/{server_id}/metrics", method="GET", params=params
+            )
+            break
+        except hcloud.APIException as e:
+            if e.code != "rate_limit_exceeded" or attempt == retries - 1:
+                raise
+            time.sleep(limiter.min_interval * 2 ** attempt)
+    time_series = resp["metrics"]["time_series"]
+    return {
+        name: [float(v) for _, v in series["values"]]
+        for name, series in time_series.items()
+    }
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """Linearly interpolated `p`th percentile of `values`."""
+    if not values:
+        raise ValueError("percentile of empty sequence")
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+@dataclass
+class MetricSummary:
+    percentiles: Dict[int, float]
+    max: float
+
+
+def summarize(raw: Mapping[str, Sequence[float]]) -> Dict[str, MetricSummary]:
+    """Sum related series (e.g. read and write IOPS) and compute their percentiles."""
+    summaries = {}
+    for name, series_names in SERIES.items():
+        series = [raw[s] for s in series_names if raw.get(s)]
+        if not series:
+            continue
+        values = [sum(point) for point in zip(*series)]
+        summaries[name] = MetricSummary(
+            percentiles={p: percentile(values, p) for p in PERCENTILES},
+            max=max(values),
+        )
+    return summaries
+
+
+@dataclass
+class Recommendation:
+    action: str  # "upsize", "downsize" or "keep"
+    server_type: str
+    cpu_utilization: Optional[float]
+    notes: List[str] = field(default_factory=list)
+
+
+def recommend_server_type(
+    current: BoundServerType,
+    catalog: Sequence[BoundServerType],
+    cpu_p95: Optional[float],
+    disk_size: int,
+    upsize_above: float = 0.8,
+    downsize_below: float = 0.2,
+    target: float = 0.6,
+) -> Recommendation:
+    """Recommend a server type from the same family as `current` based on p95 CPU usage.
+
+    `cpu_p95` is the Hetzner cpu metric, in percent of a single core. Utilization is that divided
+    by the available cores. Downsizing only considers types whose disk fits `disk_size`, since
+    disks can't shrink. Hetzner doesn't report memory usage, so less memory is only
+    flagged in the notes.
+    """
+    if cpu_p95 is None:
+        return Recommendation("keep", current.name, None, ["no cpu metrics"])
+    utilization = cpu_p95 / (100 * current.cores)
+    family = sorted(
+        (
+            t
+            for t in catalog
+            if not t.deprecated
+            and t.cpu_type == current.cpu_type
+            and t.storage_type == current.storage_type
+        ),
+        key=lambda t: (t.cores, t.memory, t.disk),
+    )
+    notes = []
+    if utilization > upsize_above:
+        for t in family:
+            if t.cores > current.cores and t.disk >= disk_size:
+                return Recommendation("upsize", t.name, utilization, notes)
+        notes.append("already the largest type of its family")
+    elif utilization < downsize_below:
+        for t in family:
+            if t.cores >= current.cores:
+                break
+            if t.disk < disk_size:
+                continue
+            if cpu_p95 / (100 * t.cores) <= target:
+                if t.memory < current.memory:
+                    notes.append(f"{t.memory:g}GB memory, check memory usage")
+                return Recommendation("downsize", t.name, utilization, notes)
+    return Recommendation("keep", current.name, utilization, notes)
@@ -8,5 +8,7 @@
   resources = { evalResources, zipAttrs, resourcesByType, ... }: {
     hcloudSshKeys = evalResources ./hcloud_sshkey.nix (zipAttrs resourcesByType.hcloudSshKeys or []);
     hcloudVolumes = evalResources ./hcloud_volume.nix (zipAttrs resourcesByType.hcloudVolumes or []);
+    hcloudNetworks = evalResources ./hcloud_network.nix (zipAttrs resourcesByType.hcloudNetworks or []);
+    hcloudLoadBalancers = evalResources ./hcloud_loadbalancer.nix (zipAttrs resourcesByType.hcloudLoadBalancers or []);
   };
 }
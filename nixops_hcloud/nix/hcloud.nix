@@ -2,6 +2,10 @@
 { config, pkgs, lib, ... }:
 with lib;
 with import ./lib.nix lib;
+let
+  cfg = config.deployment.hcloud;
+  privateInterfaces = genList (i: "ens${toString (10 + i)}") (length cfg.networks);
+in
 {
   ###### interface
 
@@ -27,6 +31,22 @@ with import ./lib.nix lib;
       '';
     };
 
+    imageSelection = mkOption {
+      type = types.enum [ "newest" "closure" ];
+      default = "newest";
+      description = ''
+        How to choose between multiple images matching
+        <option>deployment.hcloud.image_selector</option> when creating the server.
+        <literal>newest</literal> uses the most recent one. <literal>closure</literal> uses the
+        image whose system closure, as recorded by <command>nixops hcloud-bake-image</command>,
+        is missing the fewest store paths of the system being deployed. nixops creates servers
+        before building their configuration, so for a new machine the system being deployed is
+        taken from an earlier <command>nixops deploy --build-only</command> or, failing that,
+        from a deployed machine with the same <option>image_selector</option>. It falls back to
+        the newest image when either closure isn't in the local store.
+      '';
+    };
+
     location = mkOption {
       type = types.str;
       example = "fsn1";
@@ -35,6 +55,18 @@ with import ./lib.nix lib;
       '';
     };
 
+    fallbackLocations = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      example = [ "nbg1" "hel1" ];
+      description = ''
+        Locations to try, in order, when the server type is not available in
+        <option>deployment.hcloud.location</option> at creation time. Locations without capacity
+        for the server type are tried last, and locations that don't match the machine's volumes
+        are skipped. Has no effect on existing servers.
+      '';
+    };
+
     serverType = mkOption {
       type = types.str;
       example = "cx11";
@@ -83,6 +115,8 @@ with import ./lib.nix lib;
             default = {};
             description = ''
               Options to be forwarded to <option>fileSystems.mountPoint</option>.
+              If the volume was created with a <option>format</option>, <option>fsType</option>
+              defaults to it and <option>autoFormat</option> is ignored.
             '';
           };
         };
@@ -94,19 +128,116 @@ with import ./lib.nix lib;
           List of volumes attached to the machine.
         '';
       };
+
+    networks = mkOption {
+      type = types.listOf (types.either types.str (resource "hcloud-network"));
+      default = [];
+      description = ''
+        List of private networks the machine is attached to. The private interfaces are configured
+        with DHCP in the same order, starting at <literal>ens10</literal>.
+      '';
+    };
+
+    serveClosures = mkOption {
+      type = types.bool;
+      default = false;
+      description = ''
+        Whether to serve this machine's Nix store as a binary cache on its private networks, so
+        machines using it as <option>deployment.hcloud.closureSeed</option> can substitute from it.
+        The cache listens on port 5000 and is only reachable from the private interfaces. Paths
+        are signed with a key nixops generates for this machine, which machines using it as a
+        seed trust.
+      '';
+    };
+
+    storeVolume = {
+      enable = mkOption {
+        type = types.bool;
+        default = false;
+        description = ''
+          Whether to keep a copy of the machine's closures on a dedicated Hetzner Cloud volume,
+          named after the deployment and machine, that outlives the server.
+          The volume is created and attached automatically and reattached when the server is
+          recreated, so a replacement server substitutes everything it already had from local
+          disk and only the difference is copied from the deployer.
+
+          The volume holds a binary cache rather than <filename>/nix</filename> itself, since
+          mounting it over the store would hide the system the server booted with. Each deploy
+          removes paths outside the deployed closure from it, and a warning is shown if the
+          closure doesn't fit.
+
+          The volume is found by its <literal>nixops/store</literal> label and is kept when the
+          machine is destroyed, so it's still billed. Delete it by hand once it's no longer
+          needed, e.g. with <command>hcloud volume list -l nixops/store</command> and
+          <command>hcloud volume delete</command>.
+        '';
+      };
+
+      size = mkOption {
+        type = types.int;
+        default = 20;
+        description = "Size of the store volume, in Gb. Can be increased but not decreased.";
+      };
+
+      mountPoint = mkOption {
+        type = types.str;
+        default = "/var/cache/nix-store";
+        description = "Where the store volume is mounted.";
+      };
+    };
+
+    closureSeed = mkOption {
+      type = types.nullOr types.str;
+      default = null;
+      example = "seed";
+      description = ''
+        Name of a machine in the same deployment, sharing a private network with this one and
+        with <option>deployment.hcloud.serveClosures</option> enabled. Closures are copied once
+        to the seed and this machine substitutes them from it over the private network. Paths
+        the seed can't provide, e.g. on the first deploy, are copied from the deployer. If the
+        seed isn't such a machine, a warning is shown and closures are copied from the deployer.
+      '';
+    };
   };
 
   ###### implementation
 
-  config = mkIf (config.deployment.targetEnv == "hcloud") {
-    nixpkgs.system = mkOverride 900 "x86_64-linux";
+  config = mkIf (config.deployment.targetEnv == "hcloud") (mkMerge [
+    {
+      nixpkgs.system = mkOverride 900 "x86_64-linux";
 
-    boot.loader.grub.enable = true;
-    boot.loader.grub.version = 2;
-    system.stateVersion = "20.03";
-    boot.loader.grub.devices = ["/dev/sda"];
+      boot.loader.grub.enable = true;
+      boot.loader.grub.version = 2;
+      system.stateVersion = "20.03";
+      boot.loader.grub.devices = ["/dev/sda"];
 
-    networking.interfaces.ens3.useDHCP = true;
-    services.openssh.enable = true;
-  };
+      networking.interfaces.ens3.useDHCP = true;
+      services.openssh.enable = true;
+    }
+
+    {
+      networking.interfaces = listToAttrs (
+        map (iface: nameValuePair iface { useDHCP = true; }) privateInterfaces
+      );
+    }
+
+    (mkIf cfg.serveClosures {
+      # The port is pinned since nixops connects to it, and the signing key is generated by
+      # nixops and sent as deployment.keys.nix-serve-key
+      services.nix-serve = {
+        enable = true;
+        port = 5000;
+        secretKeyFile = "/run/keys/nix-serve-key";
+      };
+      systemd.services.nix-serve = {
+        after = [ "nix-serve-key-key.service" ];
+        wants = [ "nix-serve-key-key.service" ];
+      };
+      networking.firewall.interfaces = listToAttrs (
+        map
+          (iface: nameValuePair iface { allowedTCPPorts = [ config.services.nix-serve.port ]; })
+          privateInterfaces
+      );
+    })
+  ]);
 }
@@ -0,0 +1,162 @@
+{ config, lib, uuid, name, ... }:
+with lib;
+with import ./lib.nix lib;
+let
+  healthCheckType = types.submodule {
+    options = {
+      protocol = mkOption {
+        type = types.nullOr (types.enum [ "tcp" "http" ]);
+        default = null;
+        description = "Health check protocol. Defaults to the service protocol.";
+      };
+
+      port = mkOption {
+        type = types.nullOr types.int;
+        default = null;
+        description = "Port the health check connects to. Defaults to the destination port.";
+      };
+
+      interval = mkOption {
+        type = types.int;
+        default = 15;
+        description = "Seconds between health checks.";
+      };
+
+      timeout = mkOption {
+        type = types.int;
+        default = 10;
+        description = "Seconds a health check may take.";
+      };
+
+      retries = mkOption {
+        type = types.int;
+        default = 3;
+        description = "Failed health checks before a target is taken out of rotation.";
+      };
+
+      httpPath = mkOption {
+        type = types.str;
+        default = "/";
+        description = "Path requested by HTTP health checks.";
+      };
+
+      statusCodes = mkOption {
+        type = types.listOf types.str;
+        default = [ "2??" "3??" ];
+        description = "Status codes HTTP health checks accept, <literal>?</literal> matches any digit.";
+      };
+    };
+  };
+
+  serviceType = types.submodule {
+    options = {
+      protocol = mkOption {
+        type = types.enum [ "tcp" "http" ];
+        default = "tcp";
+        description = "Protocol of the service.";
+      };
+
+      listenPort = mkOption {
+        type = types.int;
+        example = 80;
+        description = "Port the load balancer listens on. Identifies the service.";
+      };
+
+      destinationPort = mkOption {
+        type = types.nullOr types.int;
+        default = null;
+        description = "Port traffic is forwarded to on the targets. Defaults to the listen port.";
+      };
+
+      proxyprotocol = mkOption {
+        type = types.bool;
+        default = false;
+        description = "Whether to use the PROXY protocol when connecting to the targets.";
+      };
+
+      healthCheck = mkOption {
+        type = healthCheckType;
+        default = {};
+        description = "Health check of the targets.";
+      };
+    };
+  };
+in
+{
+  options = {
+    inherit (import ./context.nix { inherit lib; }) token context;
+
+    name = mkOption {
+      default = "nixops-${uuid}-${name}";
+      type = types.str;
+      description = "Name of the Hetzner Cloud load balancer.";
+    };
+
+    loadBalancerType = mkOption {
+      type = types.str;
+      default = "lb11";
+      description = "Hetzner Cloud load balancer type name.";
+    };
+
+    location = mkOption {
+      type = types.str;
+      example = "fsn1";
+      description = "Load balancer location name.";
+    };
+
+    algorithm = mkOption {
+      type = types.enum [ "round_robin" "least_connections" ];
+      default = "round_robin";
+      description = "Algorithm used to distribute connections between targets.";
+    };
+
+    services = mkOption {
+      type = types.listOf serviceType;
+      default = [];
+      description = "Services exposed by the load balancer.";
+    };
+
+    targetMachines = mkOption {
+      type = types.nullOr (types.nonEmptyListOf types.str);
+      default = null;
+      example = [ "web1" "web2" ];
+      description = ''
+        Names of the machines of this deployment to balance between. All hcloud machines of the
+        deployment are targets when <literal>null</literal>.
+      '';
+    };
+
+    targetSelector = mkOption {
+      type = types.str;
+      description = ''
+        <link xlink:href='https://docs.hetzner.cloud/#label-selector'>Label selector</link> of
+        the target servers. Hetzner adds and removes servers as their labels match, so machines
+        joining or leaving the deployment don't require updating the load balancer. Defaults to
+        the deployment's machines, restricted to <option>targetMachines</option> if set.
+      '';
+    };
+
+    usePrivateIp = mkOption {
+      type = types.bool;
+      default = false;
+      description = ''
+        Whether to send traffic to the targets' private IPs. Requires <option>network</option>.
+      '';
+    };
+
+    network = mkOption {
+      type = types.nullOr (types.either types.str (resource "hcloud-network"));
+      default = null;
+      description = "Private network the load balancer is attached to.";
+    };
+  };
+
+  config = {
+    _type = "hcloud-loadbalancer";
+    targetSelector = mkDefault (concatStringsSep "," (
+      [ "nixops/deployment=${uuid}" ]
+      ++ optional (config.targetMachines != null)
+        "nixops/name in (${concatStringsSep "," config.targetMachines})"
+    ));
+  };
+}
@@ -0,0 +1,44 @@
+{ lib, uuid, name, ... }:
+with lib;
+{
+  options = {
+    inherit (import ./context.nix { inherit lib; }) token context;
+
+    name = mkOption {
+      default = "nixops-${uuid}-${name}";
+      type = types.str;
+      description = "Name of the Hetzner Cloud network.";
+    };
+
+    ipRange = mkOption {
+      type = types.str;
+      default = "10.0.0.0/16";
+      description = "IP range of the whole network, in CIDR notation.";
+    };
+
+    subnets = mkOption {
+      type = types.listOf (types.submodule {
+        options = {
+          ipRange = mkOption {
+            type = types.str;
+            example = "10.0.1.0/24";
+            description = "IP range of the subnet, must be contained in the network range.";
+          };
+
+          networkZone = mkOption {
+            type = types.str;
+            default = "eu-central";
+            description = "Network zone of the subnet.";
+          };
+        };
+      });
+      default = [ { ipRange = "10.0.1.0/24"; } ];
+      description = ''
+        Subnets of the network. Servers get private IPs from the subnet in their network zone.
+        Subnets can be added but not removed.
+      '';
+    };
+  };
+
+  config._type = "hcloud-network";
+}
@@ -21,6 +21,16 @@ with lib;
       example = "fsn1";
       description = "Volume location name";
     };
+
+    format = mkOption {
+      type = types.nullOr (types.enum [ "ext4" "xfs" ]);
+      default = null;
+      description = ''
+        Filesystem the volume is formatted with when it's created. Machines mounting a
+        pre-formatted volume use this as the default <option>fsType</option> and skip formatting
+        it on the host. Can't be changed after the volume is created.
+      '';
+    };
   };
 
   config._type = "hcloud-volume";
@@ -0,0 +1,78 @@
+"""Typed Hetzner Cloud operations and their grouping into dependency ordered steps."""
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Sequence
+
+CREATE = "create"
+RESIZE = "resize"
+ATTACH = "attach"
+DETACH = "detach"
+CHANGE_TYPE = "change-type"
+UPDATE = "update"
+DELETE = "delete"
+
+# Rough number of API calls per operation, including polling the resulting action once
+API_CALLS: Dict[str, int] = {
+    CREATE: 2,
+    RESIZE: 2,
+    ATTACH: 2,
+    DETACH: 2,
+    # shutdown, change type and power on, each with its action
+    CHANGE_TYPE: 6,
+    UPDATE: 2,
+    DELETE: 2,
+}
+
+
+@dataclass(frozen=True)
+class Operation:
+    kind: str
+    resource: str
+    resource_type: str
+    description: str = ""
+    # Names of resources whose operations must run first
+    depends_on: FrozenSet[str] = field(default_factory=frozenset)
+
+    @property
+    def api_calls(self) -> int:
+        return API_CALLS[self.kind]
+
+
+def group_steps(operations: Sequence[Operation]) -> List[List[Operation]]:
+    """Group operations into steps which can each run in parallel.
+
+    All operations of a resource go in the same step, since a resource applies its changes at
+    once. A resource goes in the step after the last of its dependencies which have operations;
+    dependencies without operations are already satisfied.
+
+    Raises
+    ------
+    `Exception`
+        If the dependencies are cyclic.
+    """
+    by_resource: Dict[str, List[Operation]] = {}
+    for op in operations:
+        by_resource.setdefault(op.resource, []).append(op)
+    deps = {
+        name: {d for op in ops for d in op.depends_on if d in by_resource and d != name}
+        for name, ops in by_resource.items()
+    }
+
+    steps: Dict[str, int] = {}
+    visiting = set()
+
+    def step_of(name: str) -> int:
+        if name not in steps:
+            if name in visiting:
+                raise Exception(f"Cyclic dependency involving {name!r}")
+            visiting.add(name)
+            steps[name] = max((step_of(d) + 1 for d in deps[name]), default=0)
+            visiting.remove(name)
+        return steps[name]
+
+    grouped: List[List[Operation]] = []
+    for name in by_resource:
+        step = step_of(name)
+        while len(grouped) <= step:
+            grouped.append([])
+        grouped[step].extend(by_resource[name])
+    return grouped
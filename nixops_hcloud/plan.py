@@ -0,0 +1,128 @@
+"""Plan and apply the Hetzner Cloud changes of a whole deployment.
+
+Planning compares the deployment's definitions with the recorded state of its hcloud resources and
+lists the operations needed to reconcile them, without changing anything. Applying runs those
+operations in steps, in dependency order, with the resources of each step handled in parallel.
+Resources without operations aren't touched, but each resource with operations goes through its
+full `create`, which can make changes that aren't planned, such as creating a store volume.
+"""
+from typing import Dict, FrozenSet, List
+
+import nixops.parallel
+from nixops.deployment import Deployment
+from nixops.resources import ResourceDefinition, ResourceEval, ResourceState
+from nixops_hcloud.backends.hcloud import HcloudDefinition, HcloudState
+from nixops_hcloud.operations import CREATE, DELETE, Operation
+from nixops_hcloud.resources.hcloud_loadbalancer import \
+    HcloudLoadBalancerDefinition
+from nixops_hcloud.resources.hcloud_network import HcloudNetworkDefinition
+from nixops_hcloud.resources.hcloud_sshkey import HcloudSshKeyDefinition
+from nixops_hcloud.resources.hcloud_volume import HcloudVolumeDefinition
+
+# Resources which may reference the others, and so are deleted first
+REFERRING_TYPES = frozenset({"hcloud", "hcloud-loadbalancer"})
+HCLOUD_TYPES = REFERRING_TYPES | {"hcloud-network", "hcloud-sshkey", "hcloud-volume"}
+
+
+def references(defn: ResourceDefinition) -> FrozenSet[str]:
+    """Names of the resources of the deployment `defn` refers to."""
+    if isinstance(defn, HcloudDefinition):
+        hetzner = defn.config.hcloud
+        refs = list(hetzner.sshKeys) + list(hetzner.networks)
+        refs += [v.volume for v in hetzner.volumes]
+    elif isinstance(defn, HcloudLoadBalancerDefinition):
+        refs = [defn.config.network]
+    else:
+        refs = []
+    return frozenset(r._name for r in refs if isinstance(r, ResourceEval))
+
+
+def describe_new(defn: ResourceDefinition) -> str:
+    if isinstance(defn, HcloudDefinition):
+        hetzner = defn.config.hcloud
+        return f"{hetzner.serverType} in {hetzner.location}"
+    if isinstance(defn, HcloudVolumeDefinition):
+        return f"{defn.config.size}GB in {defn.config.location}"
+    if isinstance(defn, HcloudLoadBalancerDefinition):
+        return f"{defn.config.loadBalancerType} in {defn.config.location}"
+    if isinstance(defn, HcloudNetworkDefinition):
+        return defn.config.ipRange
+    if isinstance(defn, HcloudSshKeyDefinition):
+        return defn.config.name
+    return ""
+
+
+def exists(res: ResourceState) -> bool:
+    if isinstance(res, HcloudState):
+        return res.vm_id is not None
+    return res.state == ResourceState.UP
+
+
+def plan_deployment(depl: Deployment) -> List[Operation]:
+    """Operations needed to bring the deployment's hcloud resources in line with its definitions.
+
+    Uses the recorded state, run `nixops check` first to refresh it. `depl.evaluate()` must have
+    been called.
+    """
+    ops: List[Operation] = []
+    for name, defn in sorted(depl.definitions.items()):
+        if defn.get_type() not in HCLOUD_TYPES:
+            continue
+        res = depl.resources.get(name)
+        if res is None or not exists(res):
+            ops.append(
+                Operation(
+                    CREATE, name, defn.get_type(), describe_new(defn), references(defn)
+                )
+            )
+        else:
+            ops.extend(res.plan(defn))
+
+    obsolete = [
+        res
+        for name, res in sorted(depl.resources.items())
+        if name not in depl.definitions
+        and res.get_type() in HCLOUD_TYPES
+        and exists(res)
+    ]
+    # Servers and load balancers go first so they release volumes and networks before those are
+    # deleted
+    referring = frozenset(op.resource for op in ops) | frozenset(
+        r.name for r in obsolete if r.get_type() in REFERRING_TYPES
+    )
+    for res in obsolete:
+        depends_on = frozenset() if res.get_type() in REFERRING_TYPES else referring
+        ops.append(Operation(DELETE, res.name, res.get_type(), "", depends_on))
+    return ops
+
+
+def apply_steps(depl: Deployment, steps: List[List[Operation]]) -> None:
+    """Run planned steps in order, the resources of each step in parallel.
+
+    Each resource applies all of its operations at once through its `create` or `destroy` method.
+    `depl.evaluate_active()` must have been called, so new resources have a state.
+    """
+
+    def worker(ops: List[Operation]) -> None:
+        op = ops[0]
+        if op.kind == DELETE:
+            res = depl.resources[op.resource]
+            if res.destroy():
+                depl.delete_resource(res)
+            return
+        depl.resources[op.resource].create(
+            depl.definitions[op.resource],
+            check=False,
+            allow_reboot=False,
+            allow_recreate=False,
+        )
+
+    for step in steps:
+        by_resource: Dict[str, List[Operation]] = {}
+        for op in step:
+            by_resource.setdefault(op.resource, []).append(op)
+        nixops.parallel.run_tasks(
+            nr_workers=len(by_resource),
+            tasks=list(by_resource.values()),
+            worker_fun=worker,
+        )
@@ -1,4 +1,5 @@
 import os.path
+from argparse import ArgumentParser, _SubParsersAction
 
 import nixops.plugins
 from nixops.plugins import Plugin
@@ -16,6 +17,12 @@ class HcloudPlugin(Plugin):
             "nixops_hcloud.resources",
         ]
 
+    @staticmethod
+    def parser(parser: ArgumentParser, subparsers: _SubParsersAction) -> None:
+        from nixops_hcloud.script_defs import add_parsers
+
+        add_parsers(parser, subparsers)
+
 
 @nixops.plugins.hookimpl
 def plugin() -> Plugin:
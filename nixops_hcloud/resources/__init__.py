@@ -1,2 +1,3 @@
 # pylint: disable=unused-variable
-from . import hcloud_sshkey, hcloud_volume
+from . import (hcloud_loadbalancer, hcloud_network, hcloud_sshkey,
+               hcloud_volume)
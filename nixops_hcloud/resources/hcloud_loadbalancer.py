@@ -0,0 +1,389 @@
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Union
+
+import hcloud
+from hcloud.load_balancer_types.domain import LoadBalancerType
+from hcloud.load_balancers.client import (BoundLoadBalancer,
+                                          LoadBalancersClient)
+from hcloud.load_balancers.domain import (LoadBalancerAlgorithm,
+                                          LoadBalancerHealtCheckHttp,
+                                          LoadBalancerHealthCheck,
+                                          LoadBalancerService,
+                                          LoadBalancerTarget,
+                                          LoadBalancerTargetLabelSelector)
+from hcloud.locations.domain import Location
+from hcloud.networks.domain import Network
+from nixops.resources import (ResourceDefinition, ResourceEval,
+                              ResourceOptions, ResourceState)
+from nixops.util import attr_property
+from nixops_hcloud.aio import ApiFacade
+from nixops_hcloud.hcloud_resources import (EntityResource, entity_check,
+                                            entity_create, entity_destroy,
+                                            entity_wait, get_by_name)
+from nixops_hcloud.hcloud_util import HcloudContextOptions
+from nixops_hcloud.operations import (ATTACH, CHANGE_TYPE, DETACH, UPDATE,
+                                      Operation)
+from nixops_hcloud.resources.hcloud_network import HcloudNetworkState
+
+
+class HcloudHealthCheckOptions(ResourceOptions):
+    protocol: Optional[str]
+    port: Optional[int]
+    interval: int
+    timeout: int
+    retries: int
+    httpPath: str
+    statusCodes: Sequence[str]
+
+
+class HcloudServiceOptions(ResourceOptions):
+    protocol: str
+    listenPort: int
+    destinationPort: Optional[int]
+    proxyprotocol: bool
+    healthCheck: HcloudHealthCheckOptions
+
+
+class HcloudLoadBalancerOptions(HcloudContextOptions):
+    name: str
+    loadBalancerType: str
+    location: str
+    algorithm: str
+    services: Sequence[HcloudServiceOptions]
+    targetSelector: str
+    usePrivateIp: bool
+    network: Optional[Union[str, ResourceEval]]
+
+
+class HcloudLoadBalancerDefinition(ResourceDefinition):
+    config: HcloudLoadBalancerOptions
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "hcloud-loadbalancer"
+
+    @classmethod
+    def get_resource_type(cls) -> str:
+        return "hcloudLoadBalancers"
+
+
+class HcloudLoadBalancerState(
+    ResourceState[HcloudLoadBalancerDefinition],
+    EntityResource[HcloudLoadBalancerDefinition, BoundLoadBalancer],
+):
+    definition_type = HcloudLoadBalancerDefinition
+    api_kind = "load_balancers"
+
+    state = attr_property("state", ResourceState.MISSING, int)
+    token = attr_property("hcloud.token", None, str)
+    hcloud_id = attr_property("hcloud.id", None, int)
+    hcloud_name = attr_property("hcloud.name", None, str)
+    load_balancer_type = attr_property("hcloud.loadBalancerType", None, str)
+    location = attr_property("hcloud.location", None, str)
+    algorithm = attr_property("hcloud.algorithm", None, str)
+    services = attr_property("hcloud.services", None, "json")
+    target_selector = attr_property("hcloud.targetSelector", None, str)
+    use_private_ip = attr_property("hcloud.usePrivateIp", False, bool)
+    network_id = attr_property("hcloud.networkId", None, int)
+    public_ipv4 = attr_property("publicIpv4", None, str)
+    _cached_client: Optional[hcloud.Client] = None
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "hcloud-loadbalancer"
+
+    def prefix_definition(self, attr):
+        return {("resources", "hcloudLoadBalancers"): attr}
+
+    @property
+    def resource_id(self) -> str:
+        return self.hcloud_id
+
+    def create(
+        self,
+        defn: HcloudLoadBalancerDefinition,
+        check: bool,
+        allow_reboot: bool,
+        allow_recreate: bool,
+    ):
+        return entity_create(self, defn, check)
+
+    def create_after(self, resources, defn):
+        return {r for r in resources if isinstance(r, HcloudNetworkState)}
+
+    def destroy(self, wipe=False) -> bool:
+        return entity_destroy(self)
+
+    def _check(self) -> bool:
+        return entity_check(self)
+
+    def entity_client(self) -> LoadBalancersClient:
+        return self._client.load_balancers
+
+    @property
+    def _client(self) -> hcloud.Client:
+        if self._cached_client is None:
+            self._cached_client = hcloud.Client(self.token)
+        return self._cached_client
+
+    def do_create_new(self, defn: HcloudLoadBalancerDefinition) -> BoundLoadBalancer:
+        config = defn.config
+        network_id = self._defn_network_id(defn)
+        services = self._defn_services(defn)
+        resp = self.entity_client().create(
+            name=self.hcloud_name,
+            load_balancer_type=LoadBalancerType(name=config.loadBalancerType),
+            location=Location(name=config.location),
+            algorithm=LoadBalancerAlgorithm(type=config.algorithm),
+            services=[_service_model(s) for s in services],
+            targets=[self._target(config.targetSelector, config.usePrivateIp)],
+            network=None if network_id is None else Network(id=network_id),
+        )
+        entity_wait(self, [resp.action])
+        self.load_balancer_type = config.loadBalancerType
+        self.location = config.location
+        self.algorithm = config.algorithm
+        self.services = services
+        self.target_selector = config.targetSelector
+        self.use_private_ip = config.usePrivateIp
+        self.network_id = network_id
+        self.public_ipv4 = resp.load_balancer.public_net.ipv4.ip
+        return resp.load_balancer
+
+    def update(
+        self, defn: HcloudLoadBalancerDefinition, model: BoundLoadBalancer
+    ) -> None:
+        self.check_model(model)
+        config = defn.config
+        if config.location != self.location:
+            self.logger.error(
+                "Cannot update the location of a Hetzner Cloud load balancer"
+            )
+
+        if config.loadBalancerType != self.load_balancer_type:
+            self.log(f"changing type to {config.loadBalancerType}...")
+            action = model.change_type(LoadBalancerType(name=config.loadBalancerType))
+            entity_wait(self, [action])
+            self.load_balancer_type = config.loadBalancerType
+
+        if config.algorithm != self.algorithm:
+            self.log(f"changing algorithm to {config.algorithm}...")
+            action = model.change_algorithm(LoadBalancerAlgorithm(type=config.algorithm))
+            entity_wait(self, [action])
+            self.algorithm = config.algorithm
+
+        network_id = self._defn_network_id(defn)
+        if network_id != self.network_id:
+            if self.network_id is not None:
+                action = model.detach_from_network(Network(id=self.network_id))
+                entity_wait(self, [action])
+            if network_id is not None:
+                entity_wait(self, [model.attach_to_network(Network(id=network_id))])
+            self.network_id = network_id
+
+        # Services are identified by their listen port
+        current = {s["listenPort"]: s for s in self.services or []}
+        wanted = {s["listenPort"]: s for s in self._defn_services(defn)}
+        for port in current.keys() - wanted.keys():
+            self.log(f"removing service on port {port}...")
+            entity_wait(self, [model.delete_service(_service_model(current[port]))])
+        for port, service in wanted.items():
+            if port not in current:
+                self.log(f"adding service on port {port}...")
+                entity_wait(self, [model.add_service(_service_model(service))])
+            elif current[port] != service:
+                self.log(f"updating service on port {port}...")
+                entity_wait(self, [model.update_service(_service_model(service))])
+        self.services = list(wanted.values())
+
+        # Add the new target before removing the old one so machines matching both keep
+        # receiving traffic. Machines joining or leaving the deployment are picked up by
+        # Hetzner through the label selector.
+        if (
+            config.targetSelector != self.target_selector
+            or config.usePrivateIp != self.use_private_ip
+        ):
+            self.log(f"changing targets to {config.targetSelector!r}...")
+            action = model.add_target(
+                self._target(config.targetSelector, config.usePrivateIp)
+            )
+            entity_wait(self, [action])
+            if self.target_selector is not None:
+                action = model.remove_target(
+                    self._target(self.target_selector, self.use_private_ip)
+                )
+                entity_wait(self, [action])
+            self.target_selector = config.targetSelector
+            self.use_private_ip = config.usePrivateIp
+
+    def should_update(self, defn: HcloudLoadBalancerDefinition) -> bool:
+        config = defn.config
+        return (
+            self.load_balancer_type != config.loadBalancerType
+            or self.location != config.location
+            or self.algorithm != config.algorithm
+            or self.services != self._defn_services(defn)
+            or self.target_selector != config.targetSelector
+            or self.use_private_ip != config.usePrivateIp
+            or self.network_id != self._defn_network_id(defn)
+        )
+
+    def update_unchecked(self, defn: HcloudLoadBalancerDefinition) -> None:
+        model = get_by_name(self)
+        if model is None:
+            self.logger.error("Load balancer missing")
+            return
+        self.update(defn, model)
+
+    def plan(self, defn: HcloudLoadBalancerDefinition) -> List[Operation]:
+        config = defn.config
+        ops = []
+
+        def op(
+            kind: str, description: str, depends_on: FrozenSet[str] = frozenset()
+        ) -> None:
+            ops.append(Operation(kind, self.name, self.get_type(), description, depends_on))
+
+        if config.loadBalancerType != self.load_balancer_type:
+            op(CHANGE_TYPE, f"{self.load_balancer_type} -> {config.loadBalancerType}")
+        if config.algorithm != self.algorithm:
+            op(UPDATE, f"algorithm {self.algorithm} -> {config.algorithm}")
+        network = config.network
+        network_deps: FrozenSet[str] = frozenset()
+        if isinstance(network, ResourceEval):
+            # May not be created yet
+            network_id = getattr(self.depl.resources.get(network._name), "hcloud_id", None)
+            network_deps = frozenset({network._name})
+        else:
+            network_id = self._defn_network_id(defn)
+        if network_id != self.network_id or (network is not None and network_id is None):
+            if self.network_id is not None:
+                op(DETACH, f"network {self.network_id}")
+            if network is not None:
+                name = network if isinstance(network, str) else network._name
+                op(ATTACH, f"network {name}", network_deps)
+        current = {s["listenPort"]: s for s in self.services or []}
+        wanted = {s["listenPort"]: s for s in self._defn_services(defn)}
+        for port in sorted(current.keys() - wanted.keys()):
+            op(UPDATE, f"remove service on port {port}")
+        for port, service in sorted(wanted.items()):
+            if port not in current:
+                op(UPDATE, f"add service on port {port}")
+            elif current[port] != service:
+                op(UPDATE, f"update service on port {port}")
+        if (
+            config.targetSelector != self.target_selector
+            or config.usePrivateIp != self.use_private_ip
+        ):
+            op(UPDATE, f"target {config.targetSelector!r}")
+        return ops
+
+    def check_model(self, model: BoundLoadBalancer) -> None:
+        self.load_balancer_type = model.load_balancer_type.name
+        self.location = model.location.name
+        self.algorithm = model.algorithm.type
+        self.services = [_service_options(s) for s in model.services]
+        selectors = [
+            t for t in model.targets if t.type == "label_selector" and t.label_selector
+        ]
+        if selectors:
+            self.target_selector = selectors[0].label_selector.selector
+            self.use_private_ip = bool(selectors[0].use_private_ip)
+        else:
+            self.target_selector = None
+        private_net = model.private_net or []
+        self.network_id = private_net[0].network.id if private_net else None
+        self.public_ipv4 = model.public_net.ipv4.ip
+
+    def _defn_network_id(self, defn: HcloudLoadBalancerDefinition) -> Optional[int]:
+        network = defn.config.network
+        if network is None:
+            return None
+        if isinstance(network, str):
+            model = ApiFacade.for_token(self.token).get_by_name("networks", network)
+            if model is None:
+                raise Exception(f"Network {network!r} not found")
+            return model.id
+        network_res = self.depl.get_typed_resource(
+            network._name, "hcloud-network", HcloudNetworkState
+        )
+        assert network_res.hcloud_id is not None
+        return network_res.hcloud_id
+
+    @staticmethod
+    def _defn_services(defn: HcloudLoadBalancerDefinition) -> List[Dict[str, Any]]:
+        services = []
+        for s in defn.config.services:
+            destination_port = s.destinationPort or s.listenPort
+            hc = s.healthCheck
+            health_check = {
+                "protocol": hc.protocol or s.protocol,
+                "port": hc.port or destination_port,
+                "interval": hc.interval,
+                "timeout": hc.timeout,
+                "retries": hc.retries,
+            }
+            if health_check["protocol"] == "http":
+                health_check["httpPath"] = hc.httpPath
+                health_check["statusCodes"] = list(hc.statusCodes)
+            services.append(
+                {
+                    "protocol": s.protocol,
+                    "listenPort": s.listenPort,
+                    "destinationPort": destination_port,
+                    "proxyprotocol": s.proxyprotocol,
+                    "healthCheck": health_check,
+                }
+            )
+        return services
+
+    @staticmethod
+    def _target(selector: str, use_private_ip: bool) -> LoadBalancerTarget:
+        return LoadBalancerTarget(
+            type="label_selector",
+            label_selector=LoadBalancerTargetLabelSelector(selector=selector),
+            use_private_ip=use_private_ip,
+        )
+
+
+def _service_model(service: Dict[str, Any]) -> LoadBalancerService:
+    hc = service["healthCheck"]
+    http = None
+    if hc["protocol"] == "http":
+        http = LoadBalancerHealtCheckHttp(
+            path=hc["httpPath"], status_codes=hc["statusCodes"]
+        )
+    return LoadBalancerService(
+        protocol=service["protocol"],
+        listen_port=service["listenPort"],
+        destination_port=service["destinationPort"],
+        proxyprotocol=service["proxyprotocol"],
+        health_check=LoadBalancerHealthCheck(
+            protocol=hc["protocol"],
+            port=hc["port"],
+            interval=hc["interval"],
+            timeout=hc["timeout"],
+            retries=hc["retries"],
+            http=http,
+        ),
+    )
+
+
+def _service_options(service: LoadBalancerService) -> Dict[str, Any]:
+    hc = service.health_check
+    health_check = {
+        "protocol": hc.protocol,
+        "port": hc.port,
+        "interval": hc.interval,
+        "timeout": hc.timeout,
+        "retries": hc.retries,
+    }
+    if hc.protocol == "http" and hc.http is not None:
+        health_check["httpPath"] = hc.http.path
+        health_check["statusCodes"] = list(hc.http.status_codes or [])
+    return {
+        "protocol": service.protocol,
+        "listenPort": service.listen_port,
+        "destinationPort": service.destination_port,
+        "proxyprotocol": service.proxyprotocol,
+        "healthCheck": health_check,
+    }
@@ -0,0 +1,145 @@
+from typing import List, Optional, Sequence
+
+import hcloud
+from hcloud.networks.client import BoundNetwork, NetworksClient
+from hcloud.networks.domain import NetworkSubnet
+from nixops.resources import ResourceDefinition, ResourceOptions, ResourceState
+from nixops.util import attr_property
+from nixops_hcloud.hcloud_resources import (EntityResource, entity_check,
+                                            entity_create, entity_destroy,
+                                            entity_wait, get_by_name)
+from nixops_hcloud.hcloud_util import HcloudContextOptions
+from nixops_hcloud.operations import UPDATE, Operation
+
+
+class HcloudNetworkSubnetOptions(ResourceOptions):
+    ipRange: str
+    networkZone: str
+
+
+class HcloudNetworkOptions(HcloudContextOptions):
+    name: str
+    ipRange: str
+    subnets: Sequence[HcloudNetworkSubnetOptions]
+
+
+class HcloudNetworkDefinition(ResourceDefinition):
+    config: HcloudNetworkOptions
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "hcloud-network"
+
+    @classmethod
+    def get_resource_type(cls) -> str:
+        return "hcloudNetworks"
+
+
+class HcloudNetworkState(
+    ResourceState[HcloudNetworkDefinition],
+    EntityResource[HcloudNetworkDefinition, BoundNetwork],
+):
+    definition_type = HcloudNetworkDefinition
+    api_kind = "networks"
+
+    state = attr_property("state", ResourceState.MISSING, int)
+    token = attr_property("hcloud.token", None, str)
+    hcloud_id = attr_property("hcloud.id", None, int)
+    hcloud_name = attr_property("hcloud.name", None, str)
+    ip_range = attr_property("hcloud.ipRange", None, str)
+    subnets = attr_property("hcloud.subnets", None, "json")
+    _cached_client: Optional[hcloud.Client] = None
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "hcloud-network"
+
+    def prefix_definition(self, attr):
+        return {("resources", "hcloudNetworks"): attr}
+
+    @property
+    def resource_id(self) -> str:
+        return self.hcloud_id
+
+    def create(
+        self,
+        defn: HcloudNetworkDefinition,
+        check: bool,
+        allow_reboot: bool,
+        allow_recreate: bool,
+    ):
+        return entity_create(self, defn, check)
+
+    def destroy(self, wipe=False) -> bool:
+        return entity_destroy(self)
+
+    def _check(self) -> bool:
+        return entity_check(self)
+
+    def entity_client(self) -> NetworksClient:
+        if self._cached_client is None:
+            self._cached_client = hcloud.Client(self.token)
+        return self._cached_client.networks
+
+    def do_create_new(self, defn: HcloudNetworkDefinition) -> BoundNetwork:
+        self.ip_range = defn.config.ipRange
+        self.subnets = self._defn_subnets(defn)
+        return self.entity_client().create(
+            name=self.hcloud_name,
+            ip_range=self.ip_range,
+            subnets=[
+                NetworkSubnet(ip_range=ip_range, network_zone=zone, type="cloud")
+                for ip_range, zone in self.subnets
+            ],
+        )
+
+    def update(self, defn: HcloudNetworkDefinition, model: BoundNetwork) -> None:
+        self.check_model(model)
+        self.update_unchecked(defn, model)
+
+    def should_update(self, defn: HcloudNetworkDefinition) -> bool:
+        return (
+            self.ip_range != defn.config.ipRange
+            or self.subnets != self._defn_subnets(defn)
+        )
+
+    def update_unchecked(
+        self, defn: HcloudNetworkDefinition, model: Optional[BoundNetwork] = None
+    ) -> None:
+        if defn.config.ipRange != self.ip_range:
+            self.logger.error("Cannot update the IP range of a Hetzner Cloud network")
+        current = self.subnets or []
+        wanted = self._defn_subnets(defn)
+        if any(s not in wanted for s in current):
+            self.logger.error("Cannot remove subnets of a Hetzner Cloud network")
+        missing = [s for s in wanted if s not in current]
+        if not missing:
+            return
+        if model is None:
+            model = get_by_name(self)
+            if model is None:
+                self.logger.error("Network missing")
+                return
+        for ip_range, zone in missing:
+            action = model.add_subnet(
+                NetworkSubnet(ip_range=ip_range, network_zone=zone, type="cloud")
+            )
+            entity_wait(self, [action])
+            current = current + [[ip_range, zone]]
+        self.subnets = current
+
+    def plan(self, defn: HcloudNetworkDefinition) -> List[Operation]:
+        current = self.subnets or []
+        return [
+            Operation(UPDATE, self.name, self.get_type(), f"add subnet {ip_range} in {zone}")
+            for ip_range, zone in self._defn_subnets(defn)
+            if [ip_range, zone] not in current
+        ]
+
+    def check_model(self, model: BoundNetwork) -> None:
+        self.ip_range = model.ip_range
+        self.subnets = [[s.ip_range, s.network_zone] for s in model.subnets]
+
+    @staticmethod
+    def _defn_subnets(defn: HcloudNetworkDefinition) -> List[List[str]]:
+        return [[s.ipRange, s.networkZone] for s in defn.config.subnets]
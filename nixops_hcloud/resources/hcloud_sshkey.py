@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import hcloud
 from hcloud.ssh_keys.client import BoundSSHKey, SSHKeysClient
@@ -7,6 +7,7 @@ from nixops.util import attr_property
 from nixops_hcloud.hcloud_resources import (EntityResource, entity_check,
                                             entity_create, entity_destroy)
 from nixops_hcloud.hcloud_util import HcloudContextOptions, get_access_token
+from nixops_hcloud.operations import Operation
 
 
 class HcloudSshKeyOptions(HcloudContextOptions):
@@ -31,6 +32,7 @@ class HcloudSshKeyState(
     EntityResource[HcloudSshKeyDefinition, BoundSSHKey],
 ):
     definition_type = HcloudSshKeyDefinition
+    api_kind = "ssh_keys"
 
     state = attr_property("state", ResourceState.MISSING, int)
     token = attr_property("hcloud.token", None, str)
@@ -87,5 +89,9 @@ class HcloudSshKeyState(
         if self.public_key != defn.config.publicKey:
             self.logger.error("Cannot update the public key of a Hetzner Cloud SSH key")
 
+    def plan(self, defn: HcloudSshKeyDefinition) -> List[Operation]:
+        # The public key can't be updated
+        return []
+
     def check_model(self, model: BoundSSHKey) -> None:
         self.public_key = model.public_key
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import hcloud
 from hcloud.locations.domain import Location
@@ -7,14 +7,16 @@ from nixops.resources import ResourceDefinition, ResourceState
 from nixops.util import attr_property
 from nixops_hcloud.hcloud_resources import (EntityResource, entity_check,
                                             entity_create, entity_destroy,
-                                            get_by_name)
+                                            entity_wait, get_by_name)
 from nixops_hcloud.hcloud_util import HcloudContextOptions, get_access_token
+from nixops_hcloud.operations import RESIZE, Operation
 
 
 class HcloudVolumeOptions(HcloudContextOptions):
     name: str
     size: int
     location: str
+    format: Optional[str]
 
 
 class HcloudVolumeDefinition(ResourceDefinition):
@@ -34,6 +36,7 @@ class HcloudVolumeState(
     EntityResource[HcloudVolumeDefinition, BoundVolume],
 ):
     definition_type = HcloudVolumeDefinition
+    api_kind = "volumes"
 
     state = attr_property("state", ResourceState.MISSING, int)
     token = attr_property("hcloud.token", None, str)
@@ -41,6 +44,7 @@ class HcloudVolumeState(
     hcloud_name = attr_property("hcloud.name", None, str)
     size = attr_property("hcloud.size", None, int)
     location = attr_property("hcloud.location", None, str)
+    fs_format = attr_property("hcloud.format", None, str)
     _cached_client: Optional[hcloud.Client] = None
 
     @classmethod
@@ -77,29 +81,42 @@ class HcloudVolumeState(
     def do_create_new(self, defn: HcloudVolumeDefinition) -> BoundVolume:
         self.size = defn.config.size
         self.location = defn.config.location
+        self.fs_format = defn.config.format
         resp = self.entity_client().create(
-            name=self.hcloud_name, size=self.size, location=Location(name=self.location)
+            name=self.hcloud_name,
+            size=self.size,
+            location=Location(name=self.location),
+            format=self.fs_format,
         )
-        resp.action.wait_until_finished()
+        entity_wait(self, [resp.action])
         return resp.volume
 
     def update(self, defn: HcloudVolumeDefinition, model: BoundVolume) -> None:
+        self.fs_format = model.format
         if defn.config.location != model.location.name:
             self.logger.error("Cannot update the location of a Hetzner Cloud volume")
+        if defn.config.format is not None and defn.config.format != model.format:
+            self.logger.error("Cannot change the format of a Hetzner Cloud volume")
         if defn.config.size < model.size:
             self.logger.error("Cannot shrink volume")
         elif defn.config.size > model.size:
             if not self.depl.logger.confirm(f"Resize volume {self.name!r}?"):
                 return
-            model.resize(defn.config.size).wait_until_finished()
+            entity_wait(self, [model.resize(defn.config.size)])
             self.size = defn.config.size
 
     def should_update(self, defn: HcloudVolumeDefinition) -> bool:
-        return self.location != defn.config.location or self.size != defn.config.size
+        return (
+            self.location != defn.config.location
+            or self.size != defn.config.size
+            or (defn.config.format is not None and self.fs_format != defn.config.format)
+        )
 
     def update_unchecked(self, defn: HcloudVolumeDefinition) -> None:
         if defn.config.location != self.location:
             self.logger.error("Cannot update the location of a Hetzner Cloud volume")
+        if defn.config.format is not None and defn.config.format != self.fs_format:
+            self.logger.error("Cannot change the format of a Hetzner Cloud volume")
         if defn.config.size < self.size:
             self.logger.error("Cannot shrink volume")
         elif defn.config.size > self.size:
@@ -109,9 +126,19 @@ class HcloudVolumeState(
             if model is None:
                 self.logger.error("Volume missing")
                 return
-            model.resize(defn.config.size).wait_until_finished()
+            entity_wait(self, [model.resize(defn.config.size)])
             self.size = defn.config.size
 
+    def plan(self, defn: HcloudVolumeDefinition) -> List[Operation]:
+        if self.size is not None and defn.config.size > self.size:
+            return [
+                Operation(
+                    RESIZE, self.name, self.get_type(), f"{self.size}GB -> {defn.config.size}GB"
+                )
+            ]
+        return []
+
     def check_model(self, model: BoundVolume) -> None:
         self.location = model.location.name
         self.size = model.size
+        self.fs_format = model.format
@@ -0,0 +1,251 @@
+"""Hetzner Cloud specific nixops subcommands."""
+import json
+from argparse import ArgumentParser, ArgumentTypeError, Namespace, _SubParsersAction
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import nixops.parallel
+from nixops.script_defs import add_subparser, network_state, open_deployment
+from nixops_hcloud.backends.hcloud import HcloudState
+from nixops_hcloud.metrics import (PERCENTILES, MetricSummary, RateLimiter,
+                                   Recommendation)
+from nixops_hcloud.operations import Operation, group_steps
+from nixops_hcloud.plan import apply_steps, plan_deployment
+from prettytable import PrettyTable
+
+
+def parse_label(label: str) -> Tuple[str, str]:
+    key, sep, value = label.partition("=")
+    if not key:
+        raise ArgumentTypeError(f"invalid label {label!r}, expected KEY[=VALUE]")
+    return key, value if sep else ""
+
+
+def op_bake_image(args: Namespace) -> None:
+    with network_state(args) as sf:
+        depl = open_deployment(sf, args)
+        machine = depl.get_typed_resource(args.machine, "hcloud", HcloudState)
+        image_id = machine.bake_image(role=args.role, labels=dict(args.labels))
+        print(image_id)
+
+
+def op_rightsize(args: Namespace) -> None:
+    with network_state(args) as sf:
+        depl = open_deployment(sf, args)
+        machines = [
+            m
+            for m in depl.active_machines.values()
+            if isinstance(m, HcloudState)
+            and m.vm_id is not None
+            and (not args.machines or m.name in args.machines)
+        ]
+        window = timedelta(hours=args.hours)
+        limiter = RateLimiter(args.interval)
+        catalogs: Dict[str, Sequence[Any]] = {}
+
+        def worker(m: HcloudState) -> Tuple[HcloudState, Any]:
+            return m, m.rightsize(window, limiter, catalogs)
+
+        reports = sorted(
+            nixops.parallel.run_tasks(
+                nr_workers=args.batch_size, tasks=machines, worker_fun=worker
+            ),
+            key=lambda r: r[0].name,
+        )
+        if args.json:
+            print(
+                json.dumps(
+                    {
+                        m.name: _report_to_json(m, summary, rec)
+                        for m, (summary, rec) in reports
+                    },
+                    indent=2,
+                    sort_keys=True,
+                )
+            )
+            return
+        table = PrettyTable(
+            [
+                "Name",
+                "Type",
+                "CPU % p50/p95/p99",
+                "Disk IOPS p95",
+                "Disk MB/s p95",
+                "Net MB/s p95",
+                "Recommendation",
+                "Notes",
+            ]
+        )
+        table.align = "l"
+        for m, (summary, rec) in reports:
+            table.add_row(
+                [
+                    m.name,
+                    m.server_type,
+                    _format_percentiles(summary.get("cpu")),
+                    _format_p95(summary.get("disk_iops")),
+                    _format_p95(summary.get("disk_bandwidth"), 1e6),
+                    _format_p95(summary.get("network_bandwidth"), 1e6),
+                    rec.action
+                    if rec.server_type == m.server_type
+                    else f"{rec.action} to {rec.server_type}",
+                    "; ".join(rec.notes),
+                ]
+            )
+        print(table)
+
+
+def _report_to_json(
+    m: HcloudState, summary: Dict[str, MetricSummary], rec: Recommendation
+) -> Dict[str, Any]:
+    return {
+        "server_type": m.server_type,
+        "recommendation": {
+            "action": rec.action,
+            "server_type": rec.server_type,
+            "cpu_utilization": rec.cpu_utilization,
+            "notes": rec.notes,
+        },
+        "metrics": {
+            name: dict({f"p{p}": v for p, v in s.percentiles.items()}, max=s.max)
+            for name, s in summary.items()
+        },
+    }
+
+
+def _format_percentiles(summary: Optional[MetricSummary]) -> str:
+    if summary is None:
+        return "-"
+    return "/".join(f"{summary.percentiles[p]:.0f}" for p in PERCENTILES)
+
+
+def _format_p95(summary: Optional[MetricSummary], scale: float = 1) -> str:
+    if summary is None:
+        return "-"
+    return f"{summary.percentiles[95] / scale:.1f}"
+
+
+def op_plan(args: Namespace) -> None:
+    with network_state(args) as sf:
+        depl = open_deployment(sf, args)
+        depl.evaluate()
+        steps = group_steps(plan_deployment(depl))
+        if args.json:
+            print(
+                json.dumps(
+                    [[_operation_to_json(op) for op in step] for step in steps],
+                    indent=2,
+                )
+            )
+        else:
+            _print_steps(steps)
+
+
+def op_apply(args: Namespace) -> None:
+    with network_state(args) as sf:
+        depl = open_deployment(sf, args)
+        # Also creates the state of new resources, like nixops deploy does
+        depl.evaluate_active()
+        steps = group_steps(plan_deployment(depl))
+        _print_steps(steps)
+        if not steps or not depl.logger.confirm("apply these changes?"):
+            return
+        apply_steps(depl, steps)
+
+
+def _operation_to_json(op: Operation) -> Dict[str, Any]:
+    return {
+        "kind": op.kind,
+        "resource": op.resource,
+        "type": op.resource_type,
+        "description": op.description,
+        "depends_on": sorted(op.depends_on),
+        "api_calls": op.api_calls,
+    }
+
+
+def _print_steps(steps: List[List[Operation]]) -> None:
+    if not steps:
+        print("no changes")
+        return
+    for i, step in enumerate(steps, 1):
+        calls = sum(op.api_calls for op in step)
+        print(f"step {i}: {len(step)} operations, ~{calls} API calls")
+        for op in step:
+            print(f"  {op.kind:<12} {op.resource_type:<20} {op.resource:<20} {op.description}")
+    total_ops = sum(len(step) for step in steps)
+    total_calls = sum(op.api_calls for step in steps for op in step)
+    print(f"total: {total_ops} operations, ~{total_calls} API calls in {len(steps)} steps")
+    print(
+        "hcloud-apply runs the full create of each listed resource, which may also make changes "
+        + "not listed here, e.g. creating store volumes"
+    )
+
+
+def add_parsers(parser: ArgumentParser, subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "hcloud-bake-image",
+        help="snapshot a deployed Hetzner Cloud machine into an image for new servers",
+    )
+    subparser.set_defaults(op=op_bake_image)
+    subparser.add_argument("machine", metavar="MACHINE", help="machine to snapshot")
+    subparser.add_argument(
+        "--role",
+        metavar="ROLE",
+        default=None,
+        help="value of the nixops/role image label (default: the machine name)",
+    )
+    subparser.add_argument(
+        "--label",
+        dest="labels",
+        metavar="KEY[=VALUE]",
+        type=parse_label,
+        action="append",
+        default=[],
+        help="extra image label",
+    )
+
+    subparser = add_subparser(
+        subparsers,
+        "hcloud-rightsize",
+        help="recommend Hetzner Cloud server types from utilization metrics",
+    )
+    subparser.set_defaults(op=op_rightsize)
+    subparser.add_argument(
+        "machines", metavar="MACHINE", nargs="*", help="machines to report on (default: all)"
+    )
+    subparser.add_argument(
+        "--hours",
+        type=float,
+        default=7 * 24,
+        help="length of the metrics window, in hours (default: one week)",
+    )
+    subparser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4,
+        help="maximum number of machines whose metrics are fetched concurrently",
+    )
+    subparser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="minimum number of seconds between API calls (default: 1, Hetzner allows 3600/h)",
+    )
+    subparser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    subparser = add_subparser(
+        subparsers,
+        "hcloud-plan",
+        help="show the Hetzner Cloud operations a deploy needs, grouped in parallel steps",
+    )
+    subparser.set_defaults(op=op_plan)
+    subparser.add_argument("--json", action="store_true", help="print the plan as JSON")
+
+    subparser = add_subparser(
+        subparsers,
+        "hcloud-apply",
+        help="create, update and delete Hetzner Cloud resources in planned parallel steps",
+    )
+    subparser.set_defaults(op=op_apply)
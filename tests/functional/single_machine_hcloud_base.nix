@@ -10,6 +10,12 @@
     location = "hel1";
   };
 
+  resources.hcloudVolumes.test-vol-formatted = {
+    size = 10;
+    location = "hel1";
+    format = "ext4";
+  };
+
   machine = { pkgs, resources, ... }:
   {
     imports = [ ../../bootstrap/fetchHetznerKeys.nix ];
@@ -29,6 +35,11 @@
               autoFormat = true;
             };
           }
+          {
+            volume = resources.hcloudVolumes.test-vol-formatted;
+            mountPoint = "/mnt/vol-formatted";
+            fileSystem.options = [ "noatime" ];
+          }
         ];
       };
 
@@ -0,0 +1,155 @@
+import asyncio
+
+import hcloud
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from nixops_hcloud.aio import AsyncHcloudClient
+
+
+def run_with_api(routes, test, **kwargs):
+    """Run `test(client, requests)` against a fake API serving `routes`.
+
+    `requests` collects the query of every request received.
+    """
+    requests = []
+
+    @web.middleware
+    async def record(request, handler):
+        requests.append(list(request.query.items()))
+        return await handler(request)
+
+    async def main():
+        app = web.Application(middlewares=[record])
+        app.add_routes(routes)
+        server = TestServer(app)
+        await server.start_server()
+        client = AsyncHcloudClient(
+            "token", endpoint=str(server.make_url("/v1")), poll_interval=0.01, **kwargs
+        )
+        try:
+            return await test(client, requests)
+        finally:
+            await client.close()
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_get_all_follows_pagination():
+    async def volumes(request):
+        page = int(request.query["page"])
+        return web.json_response(
+            {
+                "volumes": [{"id": page}],
+                "meta": {"pagination": {"next_page": page + 1 if page < 3 else None}},
+            }
+        )
+
+    async def test(client, requests):
+        assert await client.get_all("volumes", [("label_selector", "a=b")]) == [
+            {"id": 1},
+            {"id": 2},
+            {"id": 3},
+        ]
+        assert [dict(r)["page"] for r in requests] == ["1", "2", "3"]
+        assert all(dict(r)["label_selector"] == "a=b" for r in requests)
+
+    run_with_api([web.get("/v1/volumes", volumes)], test)
+
+
+def test_request_backs_off_when_rate_limited():
+    calls = []
+
+    async def servers(request):
+        calls.append(None)
+        if len(calls) < 3:
+            return web.json_response(
+                {"error": {"code": "rate_limit_exceeded", "message": "slow down"}},
+                status=429,
+            )
+        return web.json_response({"server": {"id": 1}})
+
+    async def test(client, requests):
+        assert await client.get_by_id("servers", 1) == {"id": 1}
+        assert len(calls) == 3
+        calls.clear()
+        client.retries = 2
+        with pytest.raises(hcloud.APIException) as e:
+            await client.get_by_id("servers", 1)
+        assert e.value.code == "rate_limit_exceeded"
+
+    run_with_api([web.get("/v1/servers/1", servers)], test)
+
+
+def test_request_errors():
+    async def missing(request):
+        return web.json_response(
+            {"error": {"code": "not_found", "message": "nope"}}, status=404
+        )
+
+    async def bad_gateway(request):
+        return web.Response(
+            text="<html>502 Bad Gateway</html>", status=502, content_type="text/html"
+        )
+
+    async def test(client, requests):
+        with pytest.raises(hcloud.APIException) as e:
+            await client.get_by_id("servers", 1)
+        assert e.value.code == "not_found"
+        with pytest.raises(hcloud.APIException) as e:
+            await client.get_by_id("servers", 2)
+        assert "502" in e.value.message
+
+    run_with_api(
+        [web.get("/v1/servers/1", missing), web.get("/v1/servers/2", bad_gateway)],
+        test,
+    )
+
+
+def actions_route(statuses):
+    """Serve the actions in `statuses`, each id's list of statuses returned one poll at a time."""
+
+    async def actions(request):
+        found = []
+        for id_ in request.query.getall("id"):
+            if int(id_) in statuses:
+                history = statuses[int(id_)]
+                status = history.pop(0) if len(history) > 1 else history[0]
+                found.append(
+                    {"id": int(id_), "command": "test", "status": status, "error": None}
+                )
+        return web.json_response(
+            {"actions": found, "meta": {"pagination": {"next_page": None}}}
+        )
+
+    return [web.get("/v1/actions", actions)]
+
+
+def test_wait_for_actions():
+    statuses = {1: ["running", "running", "success"], 2: ["success"]}
+
+    async def test(client, requests):
+        polls = []
+        actions = await client.wait_for_actions([2, 1], lambda: polls.append(None))
+        assert [a["id"] for a in actions] == [2, 1]
+        assert len(polls) == 2
+        # Finished actions aren't polled again
+        assert [v for k, v in requests[-1] if k == "id"] == ["1"]
+
+    run_with_api(actions_route(statuses), test)
+
+
+def test_wait_for_actions_fails():
+    statuses = {1: ["running", "error"], 2: ["running"]}
+
+    async def test(client, requests):
+        with pytest.raises(Exception, match="failed"):
+            await client.wait_for_actions([1])
+        with pytest.raises(Exception, match="not found: 3"):
+            await client.wait_for_actions([2, 3])
+        with pytest.raises(Exception, match="Timed out"):
+            await client.wait_for_actions([2])
+
+    run_with_api(actions_route(statuses), test, action_timeout=0.05)
@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+import hcloud
+import pytest
+
+from nixops_hcloud.backends.hcloud import HcloudState
+
+
+def image(id_, closure):
+    return SimpleNamespace(id=id_, closure=closure)
+
+
+def machine(images, target):
+    # Stands in for an HcloudState, with images sorted newest first like the API returns them
+    return SimpleNamespace(
+        _api=SimpleNamespace(get_all=lambda kind, params: images),
+        _target_closure=lambda image_selector: target,
+        _image_closure=lambda image: image.closure,
+        log=lambda msg: None,
+    )
+
+
+def test_fetch_image_id_by_closure():
+    images = [image(3, {"a"}), image(2, {"a", "b"}), image(1, None)]
+    m = machine(images, {"a", "b", "c"})
+    assert HcloudState._fetch_image_id(m, None, "nixops", closure_aware=True) == 2
+    assert HcloudState._fetch_image_id(m, None, "nixops") == 3
+    assert HcloudState._fetch_image_id(m, 7, "nixops", closure_aware=True) == 7
+
+
+def test_fetch_image_id_falls_back_to_newest():
+    images = [image(3, None), image(2, None)]
+    m = machine(images, {"a"})
+    assert HcloudState._fetch_image_id(m, None, "nixops", closure_aware=True) == 3
+    images = [image(3, {"a"}), image(2, {"a", "b"})]
+    m = machine(images, None)
+    assert HcloudState._fetch_image_id(m, None, "nixops", closure_aware=True) == 3
+
+
+def datacenter(location, *server_type_ids):
+    return SimpleNamespace(
+        location=SimpleNamespace(name=location),
+        server_types=SimpleNamespace(
+            available=[SimpleNamespace(id=id_) for id_ in server_type_ids]
+        ),
+    )
+
+
+def placing_machine(datacenters):
+    # Stands in for an HcloudState creating its server, where only cx11 (id 1) exists
+    server_types = {"cx11": SimpleNamespace(id=1)}
+    m = SimpleNamespace(
+        name="machine",
+        _api=SimpleNamespace(
+            get_by_name=lambda kind, name: server_types.get(name),
+            get_all=lambda kind: datacenters,
+        ),
+        log=lambda msg: None,
+        log_start=lambda msg: None,
+        log_end=lambda msg: None,
+    )
+    m._order_by_availability = lambda locations, server_type: (
+        HcloudState._order_by_availability(m, locations, server_type)
+    )
+    return m
+
+
+def unavailable(location):
+    raise hcloud.APIException("resource_unavailable", f"{location} is full", None)
+
+
+def test_order_by_availability():
+    m = placing_machine(
+        [datacenter("fsn1"), datacenter("nbg1", 1), datacenter("hel1", 1)]
+    )
+    order = HcloudState._order_by_availability(m, ["fsn1", "nbg1", "hel1"], "cx11")
+    assert order == ["nbg1", "hel1", "fsn1"]
+    with pytest.raises(Exception, match="Server type 'cx1' not found"):
+        HcloudState._order_by_availability(m, ["fsn1", "nbg1"], "cx1")
+
+
+def test_create_server_pinned_by_volumes():
+    m = placing_machine([datacenter("fsn1", 1), datacenter("nbg1", 1)])
+    created = []
+
+    def create(location):
+        created.append(location)
+        return location
+
+    result = HcloudState._create_server(
+        m, ["fsn1", "nbg1"], {"data": "nbg1"}, 1, "cx11", create
+    )
+    assert result == ("nbg1", "nbg1")
+    assert created == ["nbg1"]
+    with pytest.raises(Exception, match="'data' in hel1"):
+        HcloudState._create_server(
+            m, ["fsn1", "nbg1"], {"data": "hel1"}, 1, "cx11", create
+        )
+
+
+def test_create_server_retries_unavailable_locations():
+    m = placing_machine([datacenter("fsn1", 1), datacenter("nbg1", 1)])
+    attempts = []
+
+    def create(location):
+        attempts.append(location)
+        if location == "fsn1":
+            unavailable(location)
+        return location
+
+    result = HcloudState._create_server(m, ["fsn1", "nbg1"], {}, 1, "cx11", create)
+    assert result == ("nbg1", "nbg1")
+    assert attempts == ["fsn1", "nbg1"]
+    # The last location's error isn't swallowed
+    with pytest.raises(hcloud.APIException):
+        HcloudState._create_server(m, ["fsn1"], {}, 1, "cx11", unavailable)
+
+    def invalid(location):
+        raise hcloud.APIException("invalid_input", "bad", None)
+
+    with pytest.raises(hcloud.APIException, match="bad"):
+        HcloudState._create_server(m, ["fsn1", "nbg1"], {}, 1, "cx11", invalid)
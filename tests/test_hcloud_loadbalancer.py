@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+from hcloud.load_balancers.client import BoundLoadBalancer
+
+from nixops_hcloud.resources.hcloud_loadbalancer import (
+    HcloudLoadBalancerState, _service_options)
+
+
+def service(protocol, listen_port, destination_port=None, health_check=None):
+    # Stands in for the evaluated service options, with the module's defaults
+    hc = dict(
+        protocol=None,
+        port=None,
+        interval=15,
+        timeout=10,
+        retries=3,
+        httpPath="/",
+        statusCodes=["2??", "3??"],
+    )
+    hc.update(health_check or {})
+    return SimpleNamespace(
+        protocol=protocol,
+        listenPort=listen_port,
+        destinationPort=destination_port,
+        proxyprotocol=False,
+        healthCheck=SimpleNamespace(**hc),
+    )
+
+
+def api_service(protocol, listen_port, destination_port, health_check):
+    # Shaped like the services of GET /load_balancers/{id}
+    data = {
+        "protocol": protocol,
+        "listen_port": listen_port,
+        "destination_port": destination_port,
+        "proxyprotocol": False,
+        "health_check": dict(interval=15, timeout=10, retries=3, **health_check),
+    }
+    if protocol != "tcp":
+        data["http"] = {
+            "sticky_sessions": False,
+            "redirect_http": False,
+            "cookie_name": "HCLBSTICKY",
+            "cookie_lifetime": 300,
+            "certificates": [],
+        }
+    return data
+
+
+def http_check(port, path="/", status_codes=("2??", "3??")):
+    return {
+        "protocol": "http",
+        "port": port,
+        "http": {
+            "domain": None,
+            "path": path,
+            "response": None,
+            "tls": False,
+            "status_codes": list(status_codes),
+        },
+    }
+
+
+def test_services_roundtrip():
+    defn = SimpleNamespace(
+        config=SimpleNamespace(
+            services=[
+                service("tcp", 22),
+                service("http", 80, 8080),
+                service(
+                    "tcp", 443, health_check={"protocol": "http", "httpPath": "/health"}
+                ),
+            ]
+        )
+    )
+    model = BoundLoadBalancer(
+        None,
+        {
+            "id": 1,
+            "services": [
+                api_service("tcp", 22, 22, {"protocol": "tcp", "port": 22}),
+                api_service("http", 80, 8080, http_check(8080)),
+                api_service("tcp", 443, 443, http_check(443, path="/health")),
+            ]
+        },
+    )
+    wanted = HcloudLoadBalancerState._defn_services(defn)
+    assert [_service_options(s) for s in model.services] == wanted
+    assert [s["healthCheck"]["protocol"] for s in wanted] == ["tcp", "http", "http"]
@@ -1,5 +1,5 @@
 from nixops_hcloud.hcloud_util import (HcloudConfig, HcloudContextOptions,
-                                       get_access_token)
+                                       closest_closure, get_access_token)
 
 
 def test_get_access_token_precedence():
@@ -26,3 +26,16 @@ def test_get_access_token_precedence():
     assert get_access_token(opt, env, cfg) == "env_token"
     del env["HCLOUD_TOKEN"]
     assert get_access_token(opt, env, cfg) == "active_token"
+
+
+def test_closest_closure():
+    target = {"a", "b", "c"}
+    candidates = [
+        ("newest", {"a"}),
+        ("unknown", None),
+        ("closest", {"a", "b", "d"}),
+        ("tie", {"b", "c"}),
+    ]
+    assert closest_closure(candidates, target) == ("closest", 1)
+    assert closest_closure([("unknown", None)], target) is None
+    assert closest_closure([], target) is None
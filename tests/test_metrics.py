@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+from nixops_hcloud.metrics import percentile, recommend_server_type, summarize
+
+
+def server_type(name, cores, memory, disk, cpu_type="shared"):
+    return SimpleNamespace(
+        name=name,
+        cores=cores,
+        memory=memory,
+        disk=disk,
+        cpu_type=cpu_type,
+        storage_type="local",
+        deprecated=False,
+    )
+
+
+CATALOG = [
+    server_type("cx11", 1, 2.0, 20),
+    server_type("cx21", 2, 4.0, 40),
+    server_type("cx31", 2, 8.0, 80),
+    server_type("cx41", 4, 16.0, 160),
+    server_type("ccx11", 2, 8.0, 80, cpu_type="dedicated"),
+]
+
+
+def test_percentile():
+    values = [4, 1, 3, 2, 5]
+    assert percentile(values, 0) == 1
+    assert percentile(values, 50) == 3
+    assert percentile(values, 100) == 5
+    assert percentile(values, 95) == 4.8
+
+
+def test_summarize_sums_related_series():
+    summary = summarize(
+        {
+            "cpu": [10.0, 20.0],
+            "disk.0.iops.read": [1.0, 2.0],
+            "disk.0.iops.write": [3.0, 4.0],
+        }
+    )
+    assert set(summary) == {"cpu", "disk_iops"}
+    assert summary["disk_iops"].max == 6.0
+    assert summary["disk_iops"].percentiles[50] == 5.0
+
+
+def test_recommend_server_type():
+    cx21, cx41 = CATALOG[1], CATALOG[3]
+    rec = recommend_server_type(cx21, CATALOG, cpu_p95=190.0, disk_size=40)
+    assert (rec.action, rec.server_type) == ("upsize", "cx41")
+    rec = recommend_server_type(cx41, CATALOG, cpu_p95=50.0, disk_size=40)
+    assert (rec.action, rec.server_type) == ("downsize", "cx21")
+    # disks can't shrink
+    rec = recommend_server_type(cx41, CATALOG, cpu_p95=50.0, disk_size=160)
+    assert (rec.action, rec.server_type) == ("keep", "cx41")
+    rec = recommend_server_type(cx21, CATALOG, cpu_p95=None, disk_size=40)
+    assert rec.action == "keep"
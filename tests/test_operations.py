@@ -0,0 +1,32 @@
+import pytest
+
+from nixops_hcloud.operations import (ATTACH, CHANGE_TYPE, CREATE, DELETE,
+                                      Operation, group_steps)
+
+
+def test_group_steps_orders_by_dependency():
+    ops = [
+        Operation(ATTACH, "machine", "hcloud", depends_on=frozenset({"vol"})),
+        Operation(CHANGE_TYPE, "machine", "hcloud"),
+        Operation(CREATE, "vol", "hcloud-volume"),
+        Operation(CREATE, "key", "hcloud-sshkey"),
+        # Dependencies without operations are already satisfied
+        Operation(CREATE, "lb", "hcloud-loadbalancer", depends_on=frozenset({"net"})),
+        Operation(DELETE, "old-vol", "hcloud-volume", depends_on=frozenset({"machine"})),
+    ]
+    steps = group_steps(ops)
+    assert [sorted((op.resource, op.kind) for op in step) for step in steps] == [
+        [("key", CREATE), ("lb", CREATE), ("vol", CREATE)],
+        [("machine", ATTACH), ("machine", CHANGE_TYPE)],
+        [("old-vol", DELETE)],
+    ]
+    assert group_steps([]) == []
+
+
+def test_group_steps_rejects_cycles():
+    ops = [
+        Operation(CREATE, "a", "hcloud", depends_on=frozenset({"b"})),
+        Operation(CREATE, "b", "hcloud", depends_on=frozenset({"a"})),
+    ]
+    with pytest.raises(Exception, match="Cyclic"):
+        group_steps(ops)